@@ -1,6 +1,8 @@
 import os
 import numpy as np
 import pickle
+import hashlib
+from collections import OrderedDict
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
@@ -12,15 +14,242 @@ from matplotlib.figure import Figure
 import imageio
 
 from torch.autograd import grad
+from torch.autograd.function import once_differentiable
 
 import time
 
-from pykeops.torch import Kernel, kernel_product
-from pykeops.torch.kernel_product.formula import *
+import torch
 
 from scipy.optimize import minimize
 
 import mesh
+import kernels
+
+
+class CurrentsDistance(torch.autograd.Function):
+    """Squared currents distance |S - T|^2 between two triangulated surfaces given by their centroids and normals.
+
+        The value and the gradients with respect to the source are computed in the same kernel pass, and the
+        per-point kernel outputs are reduced to a scalar right away. Gradients with respect to the target are
+        only computed when requested. With a batch index, the source is a stack of independent surfaces: <S, S>
+        is reduced block by block (see kernels.segments) and the distance of each surface is returned.
+    """
+
+    @staticmethod
+    def forward(ctx, CS, NS, CT, NT, gamma, cst, backend, tree, batch, ranges):
+        grad = ctx.needs_input_grad[0] or ctx.needs_input_grad[1]
+
+        SS = backend.currents(gamma, CS, CS, NS, NS, grad, ranges)
+        ST = backend.currents(gamma, CS, CT, NS, NT, grad) if tree is None else tree.currents(CS, NS, grad)
+
+        # d/dNS = 2 sum_j k v_j over S minus 2 over T, d/dCS = -2 * (the same with the second output)
+        if grad:
+            ctx.gradS = 2 * (SS[:, 1:] - ST[:, 1:])
+            ctx.gradS[:, 3:] *= -2
+
+        ctx.backend = backend
+        ctx.tree = tree
+        ctx.batch = batch
+        ctx.save_for_backward(CS, NS, CT, NT, gamma)
+
+        if batch is None:
+            return cst + SS[:, 0].sum() - 2 * ST[:, 0].sum()
+
+        return cst + torch.zeros(len(ranges), dtype=CS.dtype, device=CS.device).index_add_(0, batch, SS[:, 0] - 2 * ST[:, 0])
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, g):
+        CS, NS, CT, NT, gamma = ctx.saved_tensors
+        gCS = gNS = gCT = gNT = gcst = None
+
+        # with a batch, each source point gets the output gradient of its surface
+        gS = g if ctx.batch is None else g[ctx.batch, None]
+
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1]:
+            gCS, gNS = gS * ctx.gradS[:, 3:], gS * ctx.gradS[:, :3]
+
+        # the target only enters through -2 <S, T>, linear in the source normals
+        if ctx.needs_input_grad[2] or ctx.needs_input_grad[3]:
+            if ctx.tree is not None:
+                raise RuntimeError("currents_distance: the target of an octree approximation is constant")
+            TS = ctx.backend.currents(gamma, CT, CS, NT, gS * NS, True)
+            gCT, gNT = 4 * TS[:, 4:], -2 * TS[:, 1:4]
+
+        if ctx.needs_input_grad[5]:
+            gcst = g.sum()
+
+        return gCS, gNS, gCT, gNT, None, gcst, None, None, None, None
+
+
+def currents_distance(CS, NS, CT, NT, sigmas, cst=None, backend='auto', tree=None, batch=None):
+    """Squared RKHS norm of the difference of two surfaces seen as currents, with a sum of Gaussian kernels.
+
+        Args:
+            CS (torch tensor): source centroids
+            NS (torch tensor): source normals
+            CT (torch tensor): target centroids
+            NT (torch tensor): target normals
+            sigmas (list): sigmas of the Gaussian kernels
+            cst (torch tensor): precomputed target self-energy <T, T>, computed if None
+            backend (str or object): kernel backend, see kernels.getBackend
+            tree (CurrentsOctree): octree of the target, <S, T> is then approximated with it (see kernels.py)
+            batch (torch tensor): for a source made of several surfaces stacked, sorted index of the surface of
+                each face
+
+        Returns:
+            distance (torch tensor): scalar <S, S> - 2 <S, T> + <T, T>, or the distance of each surface with batch
+    """
+
+    backend = kernels.getBackend(backend)
+    gamma = kernels.gammas(sigmas, dtype=CS.dtype, device=CS.device)
+
+    if cst is None:
+        cst = backend.currents(gamma, CT, CT, NT, NT).sum() if tree is None else tree.currents(CT, NT).sum()
+
+    ranges = None if batch is None else kernels.segments(batch)
+
+    return CurrentsDistance.apply(CS, NS, CT, NT, gamma, cst, backend, tree, batch, ranges)
+
+
+class CheckpointedShooting(torch.autograd.Function):
+    """Geodesic shooting that only keeps the states between integrator steps.
+
+        The backward pass is the discrete adjoint of the integrator: steps are run again one at a time, last to
+        first, each with its own (double backward) graph, and the adjoint state is pulled back through it. Memory
+        no longer grows with the graphs of all nt steps, at the cost of running each step twice.
+    """
+
+    @staticmethod
+    def forward(ctx, p0, q0, step, nt, states):
+        x = (p0.detach(), q0.detach())
+        states.append(x)
+        with torch.enable_grad():
+            for i in range(nt):
+                x = tuple(y.detach() for y in step(*(y.requires_grad_(True) for y in x)))
+                states.append(x)
+
+        ctx.step = step
+        ctx.states = states
+
+        return x
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, gp, gq):
+        adj = (gp, gq)
+        for x in reversed(ctx.states[:-1]):
+            with torch.enable_grad():
+                x = tuple(y.detach().requires_grad_(True) for y in x)
+                adj = grad(ctx.step(*x), x, adj)
+
+        return adj[0], adj[1], None, None, None
+
+
+class TargetCurrents:
+    """Target side of the currents data loss: centroids, normals and self-energy of the target surface.
+
+        Entries are cached per (target mesh, sigmas, dtype, device), so Q and W optimization, restarts and
+        Optimization objects built for different initial midsurfaces share them. The cache keeps the cache_size
+        most recently used entries, which hold device tensors (and octrees).
+
+        Args:
+            CT (torch tensor): target centroids
+            NT (torch tensor): target normals
+            cst (torch tensor): currents self-energy of the target, <T, T>
+            sigmas (list): sigmas of the currents kernel
+            tree (CurrentsOctree): octree approximation of the target, None for exact kernels
+
+        Attributes:
+            BT (torch tensor): ones, weights of the target centroids in the kernel reductions
+    """
+
+    cache_size = 4
+    _cache = OrderedDict()
+
+    def __init__(self, CT, NT, cst, sigmas=None, tree=None):
+        self.CT = CT
+        self.NT = NT
+        self.cst = cst
+        self.sigmas = sigmas
+        self.tree = tree
+        self.BT = torch.ones([CT.shape[0], 1], dtype=CT.dtype, device=CT.device)
+
+    @classmethod
+    def fromCN(cls, CT, NT, K):
+        """Target given directly by its centroids and normals (e.g. compressed with mesh.compressCurrents).
+
+            Args:
+                CT (torch tensor): target centroids
+                NT (torch tensor): target normals
+                K (func): currents kernel
+
+            Returns:
+                target (TargetCurrents): target, not cached
+        """
+
+        target = cls(CT, NT, None)
+        target.cst = K(CT, CT, NT, NT, target.BT).sum()
+
+        return target
+
+    @staticmethod
+    def meshHash(VH, FH):
+        """Content hash of a mesh"""
+        h = hashlib.sha1(VH.detach().cpu().numpy().tobytes())
+        h.update(FH.detach().cpu().numpy().tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def get(cls, VH, FH, sigmas, K, dtype, deviceId, theta=None, compress=None, meshKey=None):
+        """Return the cached entry for this target and sigmas, computing it on first use.
+
+            Args:
+                VH (torch tensor): target vertices
+                FH (torch tensor): target faces
+                sigmas (list): sigmas of the currents kernel
+                K (func): currents kernel built from sigmas
+                dtype (datatype): torch datatype
+                deviceId (str): torch device
+                theta (float): accuracy parameter of the octree approximation, exact kernels if None
+                compress (float): merge target faces into Diracs at this fraction of the smallest sigma (see
+                    mesh.compressCurrents), full mesh if None
+                meshKey (str): meshHash(VH, FH) if already known
+
+            Returns:
+                target (TargetCurrents): cached target
+        """
+
+        meshKey = meshKey or cls.meshHash(VH, FH)
+        key = (meshKey, tuple(float(s) for s in sigmas), dtype, str(deviceId), theta, compress)
+
+        if key in cls._cache:
+            cls._cache.move_to_end(key)
+        else:
+            VH = VH.detach().to(dtype=dtype, device=deviceId)
+            FH = FH.detach().to(dtype=torch.long, device=deviceId)
+
+            CT, NT = mesh.compCN(VH, FH)
+
+            if compress is not None:
+                CT, NT = mesh.compressCurrents(CT, NT, compress * min(float(s) for s in sigmas))
+                print("Compressed target: %d faces -> %d Diracs" % (FH.shape[0], CT.shape[0]))
+
+            if theta is None:
+                BT = torch.ones([CT.shape[0], 1], dtype=dtype, device=deviceId)
+                cst = K(CT, CT, NT, NT, BT).sum().detach()
+                tree = None
+            else:
+                tree = kernels.CurrentsOctree(CT, NT, sigmas, theta)
+                cst = tree.currents(CT, NT).sum()
+                print("Octree target: %d faces, %d levels, %.2f%% of the pairs evaluated, relative error %.2e"
+                      % (CT.shape[0], len(tree.levels), 100 * tree.pairs / CT.shape[0] ** 2, tree.error(CT, NT)))
+
+            cls._cache[key] = cls(CT, NT, cst, list(sigmas), tree)
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+
+        return cls._cache[key]
 
 
 class Optimization:
@@ -33,16 +262,19 @@ class Optimization:
             source (numpy arr): points on midsurface arranged as grid (prior to meshing)
             VH (torch tensor): vertices of target surface
             FH (torch tensor): faces of target surface
+            backend (str or object): kernel backend, 'keops', 'torch' or 'auto' (see kernels.getBackend)
 
         Attributes:
             Q (torch tensor): midsurface vertices
             VH (torch tensor): stored target vertices
             FH (torch tensor): stored target faces
+            targetKey (str): content hash of the target mesh, keys its entries in the TargetCurrents cache
             m (int): number of points along u-axis of midsurface after downsampling
             n (int): number of points along v-axis of midsurface after downsampling
 
             torchdeviceId (str): name of torch device
             torchdtype (datatype): torch datatype
+            backend (KeOpsBackend or TorchBackend): kernel backend
 
             Qopt (torch tensor): midsurface vertices after optimization
             Wopt (torch tensor): W scalar field after optimization of midsurface
@@ -51,11 +283,12 @@ class Optimization:
 
         """
 
-    def __init__(self, source, VH, FH, m=50, n=50):
+    def __init__(self, source, VH, FH, m=50, n=50, backend='auto'):
         source = mesh.downsample(source, m, n)
         self.Q, self.FS = mesh.meshSource(source)
         self.VH, self.FH = VH, FH
         self.VH, self.FH = VH, FH
+        self.targetKey = TargetCurrents.meshHash(VH, FH)
         self.m = m
         self.n = n
 
@@ -65,63 +298,72 @@ class Optimization:
 
         self.torchdeviceId = torchdeviceId
         self.torchdtype = torchdtype
+        self.backend = kernels.getBackend(backend)
 
-    def GaussKernel(self, sigma):
-        def K(x, y, b):
-            params = {
-                'id': Kernel('gaussian(x,y)'),
-                'gamma': 1 / (sigma * sigma),
-                'backend': 'auto'
-            }
-            return kernel_product(params, x, y, b)
+    def GaussKernel(self, sigma, ranges=None):
 
-        return K
+        """Gaussian kernel K(x, y, b) = sum_j exp(-|x_i - y_j|^2 / sigma^2) b_j, block diagonal with ranges"""
 
+        return self.backend.gauss(kernels.gammas([sigma], dtype=self.torchdtype, device=self.torchdeviceId), ranges)
 
     def GaussLinKernel(self, sigma):
-        def K(x, y, u, v, b):
-            params = {
-                'id': Kernel('gaussian(x,y) * linear(u,v)'),
-                'gamma': (1 / (sigma * sigma), None),
-                'backend': 'auto'
-            }
-            return kernel_product(params, (x, u), (y, v), b)
 
-        return K
+        """Currents kernel K(x, y, u, v, b) = sum_j exp(-|x_i - y_j|^2 / sigma^2) <u_i, v_j> b_j"""
+
+        return self.backend.gaussLin(kernels.gammas([sigma], dtype=self.torchdtype, device=self.torchdeviceId))
 
     def sumGaussLinKernel(self, sigmas):
 
-        """Summation of multiple GaussLinKernels with different sigma values"""
+        """Summation of multiple GaussLinKernels with different sigma values.
+
+            All scales are evaluated inside a single reduction, exp(-gamma_s |x - y|^2) being summed over the
+            gamma vector before the product with <u, v> b.
+        """
 
-        flist = list(map(lambda s: self.GaussLinKernel(s), sigmas))
+        return self.backend.gaussLin(kernels.gammas(sigmas, dtype=self.torchdtype, device=self.torchdeviceId))
 
-        def K(x, y, u, v, b):
-            Klist = list(map(lambda f: f(x, y, u, v, b), flist))
-            return sum(Klist)
+    def sumGaussKernel(self, sigmas, ranges=None):
 
-        return K
+        """Summation of multiple GaussKernels with different sigma values, fused into a single reduction. Block
+            diagonal with ranges (see kernels.segments)"""
 
-    def sumGaussKernel(self, sigmas):
+        return self.backend.gauss(kernels.gammas(sigmas, dtype=self.torchdtype, device=self.torchdeviceId), ranges)
 
-        """Summation of multiple GaussKernels with different sigma values"""
+    def targetCurrents(self, VH, FH, sigmas, theta=None, compress=None):
 
-        flist = list(map(lambda s: self.GaussKernel(s), sigmas))
+        """Cached target terms of the currents data loss (see TargetCurrents).
+            Args:
+                VH (torch tensor): target vertices
+                FH (torch tensor): target faces
+                sigmas (list): sigmas of the currents kernel
+                theta (float): accuracy of the octree approximation of the target, exact if None
+                compress (float): scale of the target compression as a fraction of the smallest sigma, None to use
+                    the full target
+
+            Returns:
+                target (TargetCurrents): target centroids, normals and self-energy
+        """
 
-        def K(x, y, b):
-            Klist = list(map(lambda f: f(x, y, b), flist))
-            return sum(Klist)
+        # The stored target is hashed once, in __init__
+        meshKey = self.targetKey if VH is self.VH and FH is self.FH else None
 
-        return K
+        return TargetCurrents.get(VH, FH, sigmas, self.sumGaussLinKernel(sigmas), self.torchdtype, self.torchdeviceId,
+                                  theta, compress, meshKey)
 
-    def lossHippSurfQ(self, FSj, fmap, VH, FH, K):
+    def lossHippSurfQ(self, FSj, fmap, VH, FH, K, target=None, starts=1):
 
         """Data loss for Q optimization step.
             Args:
                 FSj (torch tensor): faces of joined upper and lower surfaces
-                fmap (dict): dictionary mapping vertices to incident faces
+                fmap (MeshTopology): topology of the joined surfaces
                 VH (torch tensor): target vertices
                 FH (torch tensor): target faces
                 K (func): kernel function
+                target (TargetCurrents or tuple): precomputed target terms (see targetCurrents), or target
+                    centroids and normals (CT, NT), e.g. compressed with mesh.compressCurrents; computed from VH, FH
+                    with K if None
+                starts (int): number of midsurfaces stacked in qn, the loss then returns the data loss of each of
+                    them, in one kernel pass (needs a target with sigmas, from targetCurrents)
 
             Returns:
                 loss (func): data loss function
@@ -136,9 +378,17 @@ class Optimization:
 
             return C, N
 
-        CT, NT = compCN(VH, FH)
-        BT = torch.ones([CT.shape[0], 1], dtype=self.torchdtype, device=self.torchdeviceId)
-        cst = torch.dot(K(CT, CT, NT, NT, BT).view(-1), torch.ones_like(K(CT, CT, NT, NT, BT)).view(-1))
+        if target is None:
+            target = compCN(VH, FH)
+        if isinstance(target, tuple):
+            target = TargetCurrents.fromCN(*target, K)
+
+        CT, NT, BT, cst = target.CT, target.NT, target.BT, target.cst
+
+        if starts > 1:
+            if target.sigmas is None:
+                raise ValueError("lossHippSurfQ: several starts need a target from targetCurrents")
+            batch = torch.arange(starts, device=FSj.device).repeat_interleave(FSj.shape[0])
 
         def loss(qn, wv):
             """Computes data loss with method of currents.
@@ -148,16 +398,23 @@ class Optimization:
                 Returns:
                     cost (float): numerical value of data loss
             """
+            if starts > 1:
+                CN = [compCN(mesh.generateSourceULW(mesh.doubleQ(q), torch.flatten(w), FSj, fmap), FSj)
+                      for q, w in zip(qn.chunk(starts), wv.chunk(starts))]
+                return currents_distance(torch.cat([C for C, N in CN]), torch.cat([N for C, N in CN]), CT, NT,
+                                         target.sigmas, cst, self.backend, target.tree, batch)
+
             Qd = mesh.doubleQ(qn)
             VS = mesh.generateSourceULW(Qd, torch.flatten(wv), FSj, fmap)
 
             CS, NS = compCN(VS, FSj)
 
+            if target.sigmas is not None:
+                return currents_distance(CS, NS, CT, NT, target.sigmas, cst, self.backend, target.tree)
+
             BS = torch.ones([CS.shape[0], 1], dtype=self.torchdtype, device=self.torchdeviceId)
-            a = K(CS, CS, NS, NS, BS)
-            CSdot = torch.dot(a.view(-1), torch.ones_like(a).view(-1))
-            b = K(CS, CT, NS, NT, BT)
-            CSTdot = torch.dot(b.view(-1), torch.ones_like(b).view(-1))
+            CSdot = K(CS, CS, NS, NS, BS).sum()
+            CSTdot = K(CS, CT, NS, NT, BT).sum()
 
             cost = cst + CSdot - 2 * CSTdot
 
@@ -165,15 +422,18 @@ class Optimization:
 
         return loss
 
-    def lossHippSurfW(self, FSj, fmap, VH, FH, K):
+    def lossHippSurfW(self, FSj, fmap, VH, FH, K, target=None):
 
         """Data loss for W optimization step.
             Args:
                 FSj (torch tensor): faces of joined upper and lower surfaces
-                fmap (dict): dictionary mapping vertices to incident faces
+                fmap (MeshTopology): topology of the joined surfaces
                 VH (torch tensor): target vertices
                 FH (torch tensor): target faces
                 K (func): kernel function
+                target (TargetCurrents or tuple): precomputed target terms (see targetCurrents), or target
+                    centroids and normals (CT, NT), e.g. compressed with mesh.compressCurrents; computed from VH, FH
+                    with K if None
 
             Returns:
                 loss (func): data loss function
@@ -186,9 +446,12 @@ class Optimization:
 
             return C, N
 
-        CT, NT = compCN(VH, FH)
-        BT = torch.ones([CT.shape[0], 1], dtype=self.torchdtype, device=self.torchdeviceId)
-        cst = torch.dot(K(CT, CT, NT, NT, BT).view(-1), torch.ones_like(K(CT, CT, NT, NT, BT)).view(-1))
+        if target is None:
+            target = compCN(VH, FH)
+        if isinstance(target, tuple):
+            target = TargetCurrents.fromCN(*target, K)
+
+        CT, NT, BT, cst = target.CT, target.NT, target.BT, target.cst
 
         def loss(qn, wu, wl):
             """Computes data loss with method of currents.
@@ -204,11 +467,12 @@ class Optimization:
 
             CS, NS = compCN(VS, FSj)
 
+            if target.sigmas is not None:
+                return currents_distance(CS, NS, CT, NT, target.sigmas, cst, self.backend, target.tree)
+
             BS = torch.ones([CS.shape[0], 1], dtype=self.torchdtype, device=self.torchdeviceId)
-            a = K(CS, CS, NS, NS, BS)
-            CSdot = torch.dot(a.view(-1), torch.ones_like(a).view(-1))
-            b = K(CS, CT, NS, NT, BT)
-            CSTdot = torch.dot(b.view(-1), torch.ones_like(b).view(-1))
+            CSdot = K(CS, CS, NS, NS, BS).sum()
+            CSTdot = K(CS, CT, NS, NT, BT).sum()
 
             cost = cst + CSdot - 2 * CSTdot
 
@@ -246,24 +510,97 @@ class Optimization:
 
         return HS
 
-    def Shooting(self, p0, q0, K, nt=10, Integrator=RalstonIntegrator()):
-        return Integrator(self.HamiltonianSystem(K), (p0, q0), nt)
+    def GaussHamiltonianSystem(self, K):
+
+        """Hamiltonian system of a Gaussian kernel (GaussKernel or sumGaussKernel) with closed-form gradients
+            dH/dp_i = sum_j k(q_i, q_j) p_j and dH/dq_i = -2 sum_j sum_s gamma_s exp(-gamma_s |q_i - q_j|^2)
+            <p_i, p_j> (q_i - q_j), both obtained from a single kernel reduction, without double backward.
+            Args:
+                K (func): Gaussian kernel built by a kernel backend
+
+            Returns:
+                HS (func): (p, q) -> (-dH/dq, dH/dp)
+        """
+
+        def HS(p, q):
+            r = K.backend.currents(K.gamma.to(dtype=q.dtype, device=q.device), q, q, p, p, True, K.ranges)
+            return 2 * r[:, 4:], r[:, 1:4]
+
+        return HS
+
+    def Shooting(self, p0, q0, K, nt=10, Integrator=RalstonIntegrator(), mode='autograd', hamiltonian='autograd'):
+
+        """Geodesic shooting from (p0, q0).
+            Args:
+                p0 (torch tensor): initial momentum
+                q0 (torch tensor): initial points
+                K (func): kernel
+                nt (int): number of integrator steps
+                Integrator (func): integrator
+                mode (str): 'autograd' keeps the graph of the whole trajectory, 'checkpoint' only keeps the states
+                    and computes gradients of the final state with the adjoint of the integrator steps (see
+                    CheckpointedShooting); intermediate states are then detached
+                hamiltonian (str): 'autograd' differentiates the Hamiltonian with autograd, 'gauss' uses the closed
+                    form gradients of Gaussian kernels (see GaussHamiltonianSystem)
 
-    def TotalLossIntegratedQ(self, K1, K2, dataloss, gamma=0, beta=0):
+            Returns:
+                l (list): states (p, q) after each step
+        """
+
+        if hamiltonian == 'autograd':
+            HS = self.HamiltonianSystem(K)
+        elif hamiltonian == 'gauss':
+            HS = self.GaussHamiltonianSystem(K)
+        else:
+            raise ValueError("Unknown Hamiltonian system '%s'" % hamiltonian)
+
+        if mode == 'autograd':
+            return Integrator(HS, (p0, q0), nt)
+        elif mode == 'checkpoint':
+            states = []
+            step = lambda p, q: Integrator(HS, (p, q), 1, 1.0 / nt)[-1]
+            x = CheckpointedShooting.apply(p0, q0, step, nt, states)
+            return states[:-1] + [x]
+
+        raise ValueError("Unknown shooting mode '%s'" % mode)
+
+    def TotalLossIntegratedQ(self, K1, K2, dataloss, gamma=0, beta=0, nt=10, shooting='autograd', hamiltonian='autograd',
+                             batch=None):
 
         """Total loss for Q optimization step. Includes deformation term and data attachment term.
             Args:
                 K1 (func): kernel used to compute position of vertices given momentum vector
                 K2 (func): kernel used to compute widths given momentum vector
+                nt (int): number of integrator steps of the shooting
+                shooting (str): shooting mode, see Shooting
+                hamiltonian (str): Hamiltonian system, see Shooting
+                batch (torch tensor): for several midsurfaces stacked (see optimizeQBatch), sorted index of the
+                    midsurface of each vertex; K1, K2 are then block diagonal kernels (built with the ranges of
+                    batch) and dataloss returns one loss per midsurface
             Returns:
                 loss (func): total loss, summation of deformation and data attachment losses
         """
 
-        def loss(p0, q0, a0, w0):
-            p, q = self.Shooting(p0, q0, K1)[-1]
+        starts = None if batch is None else int(batch[-1]) + 1
+
+        def loss(p0, q0, a0, w0, out=None):
+            p, q = self.Shooting(p0, q0, K1, nt=nt, mode=shooting, hamiltonian=hamiltonian)[-1]
             w = w0 + K2(q0, q0, a0)
 
-            return gamma * self.Hamiltonian(K1)(p0, q0) + beta * self.Hamiltonian(K2)(a0, q0) + dataloss(q, w)
+            # hand the endpoint and widths to the caller, so they need not be recomputed
+            if out is not None:
+                out['q'], out['w'] = q.detach(), w.detach()
+
+            if batch is None:
+                return gamma * self.Hamiltonian(K1)(p0, q0) + beta * self.Hamiltonian(K2)(a0, q0) + dataloss(q, w)
+
+            # the loss of each midsurface, the optimized loss is their sum
+            E = .5 * (gamma * (p0 * K1(q0, q0, p0)).sum(1) + beta * (a0 * K2(q0, q0, a0)).sum(1))
+            losses = torch.zeros(starts, dtype=E.dtype, device=E.device).index_add(0, batch, E) + dataloss(q, w)
+            if out is not None:
+                out['losses'] = losses.detach()
+
+            return losses.sum()
 
         return loss
 
@@ -278,9 +615,11 @@ class Optimization:
                 loss (func): total loss, summation of deformation and data attachment losses
         """
 
-        def loss(q0, a0, wu0, b0, wl0):
+        def loss(q0, a0, wu0, b0, wl0, out=None):
             wu = wu0 + K(q0, q0, a0)
             wl = wl0 + K(q0, q0, b0)
+            if out is not None:
+                out['wu'], out['wl'] = wu.detach(), wl.detach()
             wcost = gamma * (self.Hamiltonian(K)(a0, wu0) + self.Hamiltonian(K)(b0, wl0))
             currcost = beta * dataloss(q0, wu, wl)
             return wcost + currcost
@@ -298,6 +637,8 @@ class Optimization:
                 w (torch tensor): initial widths
                 dtype (datatype): data type to use for torch tensors
                 deviceId (str): torch device
+                history (str): which evaluations are recorded in the lists, 'all', 'iterations' (accepted
+                    iterates only) or 'none' (call store() to record the last evaluation)
 
             Attributes:
                 f (func): stores loss function
@@ -308,66 +649,122 @@ class Optimization:
                 feval (int): function evaluation counter
                 plist (list): list of momentum vectors for midsurface after each iteration
                 alist (list): list of momentum vectors for widths after each iteration
+                qlist (list): list of shot midsurfaces after each iteration
+                wlist (list): list of widths after each iteration
                 losslist (list): list of losses after each iteration
+                last (dict): parameters, loss and results of the last evaluation
+                stored (bool): whether the last evaluation has been recorded in the lists
+                param (tensor): flat device parameter, the momentum vectors are views of it
+                xbuf, gbuf (tensor): pinned float64 host buffers for the parameters and gradient
 
                 cached_x (numpy array): stores parameter values from previous function evaluation
                 cached_f (numpy array): stores value of loss from previous function evaluation
                 cached_jac (numpy array): stores gradients from previous function evaluation
         """
 
-        def __init__(self, objfun, param, q, w, dtype, deviceId):
+        def __init__(self, objfun, param, q, w, dtype, deviceId, history='all'):
             self.f = objfun
             self.x0 = param.cpu().data.numpy()
             self.q0 = q
             self.w0 = w
             self.dtype = dtype
             self.device = deviceId
+            self.history = history
             self.it = 0
             self.feval = 0
             self.alist = []
             self.plist = []
+            self.qlist = []
+            self.wlist = []
             self.losslist = []
+            self.last = None
+            self.stored = False
+            self.cached_x = None
+            self.buffers(self.x0.size)
+
+        def buffers(self, n):
+            # allocated once: scipy's float64 iterate and gradient go through pinned host buffers, and the device
+            # parameter is a single flat leaf whose gradient autograd accumulates in place
+            pin = torch.cuda.is_available()
+            self.xbuf = torch.empty(n, dtype=torch.float64, pin_memory=pin)
+            self.gbuf = torch.empty(n, dtype=torch.float64, pin_memory=pin)
+            self.param = torch.from_numpy(self.x0).to(dtype=self.dtype, device=self.device).requires_grad_(True)
+            self.param.grad = torch.zeros_like(self.param)
+            self.diff = np.empty(n)
+            # last evaluation on the device, for the torch driver
+            self.cached_param = torch.empty_like(self.param.detach())
+            self.cached_grad = torch.empty_like(self.param.detach())
+            self.cached_device = False
 
         def is_new(self, x):
             # if this is the first thing we've seen
-            if not hasattr(self, 'cached_x'):
+            if self.cached_x is None:
                 return True
-            else:
-                # compare x to cached_x to determine if we've been given a new input
-                x, self.cached_x = np.array(x), np.array(self.cached_x)
-                error = np.abs(x - self.cached_x)
-                return error.max() > 1e-8
-
-        def conv_param(self, x):
-            psect = x[0:self.q0.shape[0] * self.q0.shape[1]]
-            convp = torch.from_numpy(psect).view(self.q0.shape[0], self.q0.shape[1])
-            asect = x[self.q0.shape[0] * self.q0.shape[1]:]
-            conva = torch.from_numpy(asect).view(self.w0.shape[0], self.w0.shape[1])
+            if x is self.cached_x:
+                return False
+            # compare x to cached_x to determine if we've been given a new input, without temporaries
+            np.subtract(x, self.cached_x, out=self.diff)
+            np.abs(self.diff, out=self.diff)
+            return self.diff.max() > 1e-8
+
+        def conv_param(self):
+            k = self.q0.shape[0] * self.q0.shape[1]
+            convp = self.param[:k].view(self.q0.shape[0], self.q0.shape[1])
+            conva = self.param[k:].view(self.w0.shape[0], self.w0.shape[1])
             return convp, conva
 
-        def cache(self, x):
+        def evaluate(self):
+            # objective at the current device parameter, gradient in param.grad
             self.feval += 1
-            # convert x to tensor
-            ptensor, atensor = self.conv_param(x)
-            ptensor = ptensor.to(self.device).type(self.dtype).requires_grad_(True)
-            atensor = atensor.to(self.device).type(self.dtype).requires_grad_(True)
-            # store the raw array
-            self.cached_x = x
+            self.param.grad.zero_()
+            ptensor, atensor = self.conv_param()
             # calculate the objective
-            L = self.f(ptensor, self.q0, atensor, self.w0)
-            # backprop the objective
-            L.backward()
+            out = {}
+            L = self.f(ptensor, self.q0, atensor, self.w0, out)
+            # backprop the objective into param.grad only
+            L.backward(inputs=[self.param])
             self.cached_f = L.item()
             if self.feval == 1:
                 print("iteration %d" % (self.it))
             print("loss = %.2f" % self.cached_f)
-            pgrad = ptensor.grad.type(torch.float64).cpu().data.numpy().ravel()
-            agrad = atensor.grad.type(torch.float64).cpu().data.numpy().ravel()
-            self.cached_jac = np.concatenate([pgrad, agrad])
 
-            self.plist.append(ptensor)
-            self.alist.append(atensor)
-            self.losslist.append(self.cached_f)
+            self.last = {'p': ptensor, 'a': atensor, 'loss': self.cached_f, 'q': out['q'], 'w': out['w'],
+                         'losses': out.get('losses')}
+            self.stored = False
+            if self.history == 'all':
+                self.store()
+
+        def cache(self, x):
+            # copy x into the host buffer and from there to the device parameter
+            self.cached_x = self.xbuf.numpy()
+            np.copyto(self.cached_x, x)
+            with torch.no_grad():
+                self.param.copy_(self.xbuf, non_blocking=True)
+            self.cached_device = False
+            self.evaluate()
+            self.gbuf.copy_(self.param.grad)
+            self.cached_jac = self.gbuf.numpy()
+
+        def closure(self):
+            # torch.optim.LBFGS closure, reusing the last evaluation when the optimizer asks for the same point
+            # again (it re-evaluates the accepted iterate at the start of every step)
+            if self.cached_device and torch.equal(self.param, self.cached_param):
+                self.param.grad.copy_(self.cached_grad)
+                return self.cached_f
+            self.evaluate()
+            self.cached_param.copy_(self.param.detach())
+            self.cached_grad.copy_(self.param.grad)
+            self.cached_device = True
+            return self.cached_f
+
+        def store(self):
+            # p and a are views of the shared parameter buffer, so they are copied when recorded
+            self.plist.append(self.last['p'].detach().clone())
+            self.alist.append(self.last['a'].detach().clone())
+            self.qlist.append(self.last['q'])
+            self.wlist.append(self.last['w'])
+            self.losslist.append(self.last['loss'])
+            self.stored = True
 
         def fun(self, x):
             if self.is_new(x):
@@ -379,7 +776,12 @@ class Optimization:
                 self.cache(x)
             return self.cached_jac
 
-        def callback(self, x):
+        def callback(self, x=None):
+            if self.history == 'iterations':
+                # the torch driver passes no x, its last evaluation is the accepted iterate
+                if x is not None and self.is_new(x):
+                    self.cache(x)
+                self.store()
             self.it += 1
             self.feval = 0
 
@@ -394,6 +796,7 @@ class Optimization:
                 wl (torch tensor): lower surface widths
                 dtype (datatype): data type to use for torch tensors
                 deviceId (str): torch device
+                history (str): which evaluations are recorded, as in PytorchObjectiveQ
 
              Attributes:
                 f (func): stores loss function
@@ -405,14 +808,20 @@ class Optimization:
                 feval (int): function evaluation counter
                 alist (list): list of momentum vectors corresponding to upper surface after each iteration
                 alist (list): list of momentum vectors corresponding to lower surface after each iteration
+                wulist (list): list of upper surface widths after each iteration
+                wllist (list): list of lower surface widths after each iteration
                 losslist (list): list of losses after each iteration
+                last (dict): parameters, loss and results of the last evaluation
+                stored (bool): whether the last evaluation has been recorded in the lists
+                param (tensor): flat device parameter, the momentum vectors are views of it
+                xbuf, gbuf (tensor): pinned float64 host buffers for the parameters and gradient
 
                 cached_x (numpy array): stores parameter values from previous function evaluation
                 cached_f (numpy array): stores value of loss from previous function evaluation
                 cached_jac (numpy array): stores gradients from previous function evaluation
 
         """
-        def __init__(self, objfun, param, q, wu, wl, dtype, deviceId):
+        def __init__(self, objfun, param, q, wu, wl, dtype, deviceId, history='all'):
             self.f = objfun  # loss function
             self.x0 = param.cpu().data.numpy()
             self.q0 = q
@@ -420,52 +829,99 @@ class Optimization:
             self.wl0 = wl
             self.dtype = dtype
             self.device = deviceId
+            self.history = history
             self.it = 0
             self.feval = 0
             self.alist = []
             self.blist = []
+            self.wulist = []
+            self.wllist = []
             self.losslist = []
+            self.last = None
+            self.stored = False
+            self.cached_x = None
+            self.buffers(self.x0.size)
+
+        def buffers(self, n):
+            # same pinned host / flat device buffer scheme as PytorchObjectiveQ
+            pin = torch.cuda.is_available()
+            self.xbuf = torch.empty(n, dtype=torch.float64, pin_memory=pin)
+            self.gbuf = torch.empty(n, dtype=torch.float64, pin_memory=pin)
+            self.param = torch.from_numpy(self.x0).to(dtype=self.dtype, device=self.device).requires_grad_(True)
+            self.param.grad = torch.zeros_like(self.param)
+            self.diff = np.empty(n)
+            # last evaluation on the device, for the torch driver
+            self.cached_param = torch.empty_like(self.param.detach())
+            self.cached_grad = torch.empty_like(self.param.detach())
+            self.cached_device = False
 
         def is_new(self, x):
             # if this is the first thing we've seen
-            if not hasattr(self, 'cached_x'):
+            if self.cached_x is None:
                 return True
-            else:
-                # compare x to cached_x to determine if we've been given a new input
-                x, self.cached_x = np.array(x), np.array(self.cached_x)
-                error = np.abs(x - self.cached_x)
-                return error.max() > 1e-8
-
-        def conv_param(self, x):
-            asect = x[0:self.wu0.shape[0] * self.wu0.shape[1]]
-            conva = torch.from_numpy(asect).view(self.wu0.shape[0], self.wu0.shape[1])
-            bsect = x[self.wu0.shape[0] * self.wu0.shape[1]:]
-            convb = torch.from_numpy(bsect).view(self.wu0.shape[0], self.wu0.shape[1])
+            if x is self.cached_x:
+                return False
+            # compare x to cached_x to determine if we've been given a new input, without temporaries
+            np.subtract(x, self.cached_x, out=self.diff)
+            np.abs(self.diff, out=self.diff)
+            return self.diff.max() > 1e-8
+
+        def conv_param(self):
+            k = self.wu0.shape[0] * self.wu0.shape[1]
+            conva = self.param[:k].view(self.wu0.shape[0], self.wu0.shape[1])
+            convb = self.param[k:].view(self.wu0.shape[0], self.wu0.shape[1])
             return conva, convb
 
-        def cache(self, x):
+        def evaluate(self):
+            # objective at the current device parameter, gradient in param.grad
             self.feval += 1
-            # convert x to tensor
-            atensor, btensor = self.conv_param(x)
-            atensor = atensor.to(self.device).type(self.dtype).requires_grad_(True)
-            btensor = btensor.to(self.device).type(self.dtype).requires_grad_(True)
-            # store the raw array
-            self.cached_x = x
+            self.param.grad.zero_()
+            atensor, btensor = self.conv_param()
             # calculate the objective
-            L = self.f(self.q0, atensor, self.wu0, btensor, self.wl0)
-            # backprop the objective
-            L.backward()
+            out = {}
+            L = self.f(self.q0, atensor, self.wu0, btensor, self.wl0, out)
+            # backprop the objective into param.grad only
+            L.backward(inputs=[self.param])
             self.cached_f = L.item()
             if self.feval == 1:
                 print("iteration %d" % (self.it))
             print("loss = %.2f" % self.cached_f)
-            agrad = atensor.grad.type(torch.float64).cpu().data.numpy().ravel()
-            bgrad = btensor.grad.type(torch.float64).cpu().data.numpy().ravel()
-            self.cached_jac = np.concatenate([agrad, bgrad])
 
-            self.alist.append(atensor)
-            self.blist.append(btensor)
-            self.losslist.append(self.cached_f)
+            self.last = {'a': atensor, 'b': btensor, 'loss': self.cached_f, 'wu': out['wu'], 'wl': out['wl']}
+            self.stored = False
+            if self.history == 'all':
+                self.store()
+
+        def cache(self, x):
+            # copy x into the host buffer and from there to the device parameter
+            self.cached_x = self.xbuf.numpy()
+            np.copyto(self.cached_x, x)
+            with torch.no_grad():
+                self.param.copy_(self.xbuf, non_blocking=True)
+            self.cached_device = False
+            self.evaluate()
+            self.gbuf.copy_(self.param.grad)
+            self.cached_jac = self.gbuf.numpy()
+
+        def closure(self):
+            # torch.optim.LBFGS closure, reusing the last evaluation when the optimizer asks for the same point
+            # again (it re-evaluates the accepted iterate at the start of every step)
+            if self.cached_device and torch.equal(self.param, self.cached_param):
+                self.param.grad.copy_(self.cached_grad)
+                return self.cached_f
+            self.evaluate()
+            self.cached_param.copy_(self.param.detach())
+            self.cached_grad.copy_(self.param.grad)
+            self.cached_device = True
+            return self.cached_f
+
+        def store(self):
+            self.alist.append(self.last['a'].detach().clone())
+            self.blist.append(self.last['b'].detach().clone())
+            self.wulist.append(self.last['wu'])
+            self.wllist.append(self.last['wl'])
+            self.losslist.append(self.last['loss'])
+            self.stored = True
 
         def fun(self, x):
             if self.is_new(x):
@@ -477,12 +933,50 @@ class Optimization:
                 self.cache(x)
             return self.cached_jac
 
-        def callback(self, x):
+        def callback(self, x=None):
+            if self.history == 'iterations':
+                # the torch driver passes no x, its last evaluation is the accepted iterate
+                if x is not None and self.is_new(x):
+                    self.cache(x)
+                self.store()
             self.it += 1
             self.feval = 0
 
 
-    def optimizeQ(self, w, sigmacurrs, sigmadiffs, sigmaw, gamma=0, beta=0, iters=20):
+    @staticmethod
+    def minimizeTorch(obj, iters):
+
+        """L-BFGS with strong Wolfe line search in torch, on the device of the objective's parameter.
+
+            One optimizer step is taken per iteration so that obj.callback sees the accepted iterates as with
+            scipy. The stopping rules follow scipy's L-BFGS-B defaults: at most iters iterations, projected
+            gradient below gtol = 1e-5, or relative loss decrease below ftol = 2.2e-9.
+
+            Args:
+                obj (PytorchObjectiveQ or PytorchObjectiveW): objective, evaluated through obj.closure
+                iters (int): maximum number of iterations
+
+            Returns:
+                float: loss at the last iterate
+        """
+
+        # max_eval bounds the line search of a step, 20 evaluations after the first as scipy's maxls
+        optimizer = torch.optim.LBFGS([obj.param], lr=1, max_iter=1, max_eval=21, tolerance_grad=1e-5,
+                                      tolerance_change=0, history_size=10, line_search_fn='strong_wolfe')
+        f = obj.closure()
+        for it in range(iters):
+            optimizer.step(obj.closure)
+            # a step without a new iteration means the gradient test passed at its first evaluation
+            if optimizer.state[obj.param].get('n_iter', 0) == it:
+                break
+            fold, f = f, obj.closure()
+            obj.callback()
+            if fold - f <= 2.2e-9 * max(abs(fold), abs(f), 1):
+                break
+        return obj.closure()
+
+    def optimizeQ(self, w, sigmacurrs, sigmadiffs, sigmaw, gamma=0, beta=0, iters=20, theta=None, compress=None,
+                  nt=10, shooting='autograd', hamiltonian='autograd', history='all', optimizer='scipy'):
 
         """Q optimization step.
             Args:
@@ -493,13 +987,23 @@ class Optimization:
                 gamma (float): coefficient of deformation term
                 beta (float): coefficient of dataloss term
                 iters (int): maximum number of iterations
+                theta (float): accuracy of the octree approximation of the target currents (see
+                    kernels.CurrentsOctree), exact kernels if None
+                compress (float): compress the target into Diracs at this fraction of the smallest sigmacurrs
+                    (see mesh.compressCurrents), e.g. 0.5 to 1; full target if None
+                nt (int): number of integrator steps of the geodesic shooting
+                shooting (str): 'autograd', or 'checkpoint' for memory independent of nt (see Shooting)
+                hamiltonian (str): 'autograd', or 'gauss' for closed-form Hamiltonian gradients (see Shooting)
+                history (str): results returned for 'all' function evaluations, accepted 'iterations' only, or
+                    'none' (final result only)
+                optimizer (str): 'scipy' L-BFGS-B on the host, or 'torch' L-BFGS on the optimization device (see
+                    minimizeTorch)
 
             Returns:
                 pqlist (2d array): list of p's and q's
         """
 
-        Fjoined = mesh.joinFlip(self.FS, self.m, self.n)
-        facemap = mesh.incidentFaceMap(2 * self.m * self.n, Fjoined)
+        Fjoined, facemap = mesh.joinedTopology(self.FS, self.m, self.n)
 
         q0 = self.Q.clone().detach().to(dtype=self.torchdtype, device=self.torchdeviceId).requires_grad_(True)
         Fjoined = Fjoined.clone().detach().to(dtype=torch.long, device=self.torchdeviceId)
@@ -507,31 +1011,112 @@ class Optimization:
         VH = self.VH.clone().detach().to(dtype=self.torchdtype, device=self.torchdeviceId)
         FH = self.FH.clone().detach().to(dtype=torch.long, device=self.torchdeviceId)
 
-        dataloss = self.lossHippSurfQ(Fjoined, facemap, VH, FH, self.sumGaussLinKernel(sigmacurrs))
-        loss = self.TotalLossIntegratedQ(self.sumGaussKernel(sigmadiffs), self.GaussKernel(sigmaw), dataloss, gamma=gamma, beta=beta)
+        target = self.targetCurrents(self.VH, self.FH, sigmacurrs, theta, compress)
+        dataloss = self.lossHippSurfQ(Fjoined, facemap, VH, FH, self.sumGaussLinKernel(sigmacurrs), target)
+        loss = self.TotalLossIntegratedQ(self.sumGaussKernel(sigmadiffs), self.GaussKernel(sigmaw), dataloss, gamma=gamma, beta=beta,
+                                         nt=nt, shooting=shooting, hamiltonian=hamiltonian)
 
         p0 = torch.zeros(q0.shape, dtype=self.torchdtype, device=self.torchdeviceId, requires_grad=True)
         a0 = torch.zeros(w0.shape, dtype=self.torchdtype, device=self.torchdeviceId, requires_grad=True)
         pa = torch.cat((p0.flatten(), a0.flatten()))
 
-        obj = Optimization.PytorchObjectiveQ(loss, pa, q0, w0, self.torchdtype, self.torchdeviceId)
+        obj = Optimization.PytorchObjectiveQ(loss, pa, q0, w0, self.torchdtype, self.torchdeviceId, history)
+
+        if optimizer == 'torch':
+            Optimization.minimizeTorch(obj, iters)
+        else:
+            minimize(obj.fun, obj.x0, method='L-BFGS-B', jac=obj.jac, callback=obj.callback, options={'disp': True, 'maxiter': iters})
 
-        minimize(obj.fun, obj.x0, method='L-BFGS-B', jac=obj.jac, callback=obj.callback, options={'disp': True, 'maxiter': iters})
+        # the shot midsurfaces and widths were recorded during the evaluations, the last one is the result
+        if not obj.stored:
+            obj.store()
 
-        qreslist = [self.Shooting(ptens, q0, self.sumGaussKernel(sigmadiffs), nt=10)[-1][1] for ptens in obj.plist]
-        wreslist = [w0.cpu() + self.GaussKernel(sigmaw.cpu())(q0.cpu(), q0.cpu(), atens.cpu()) for atens in obj.alist]
+        qreslist = obj.qlist
+        wreslist = [wtens.cpu() for wtens in obj.wlist]
 
         self.Qopt = qreslist[-1]
         self.Wopt = wreslist[-1]
 
         return qreslist, wreslist
 
-    def optimizeW(self, wu, wl, sigmacurrs, sigmaws, gamma=1, beta=1, iters=50):
+    def optimizeQBatch(self, sources, w, sigmacurrs, sigmadiffs, sigmaw, gamma=0, beta=0, iters=20, theta=None,
+                       compress=None, nt=10, shooting='autograd', hamiltonian='autograd', history='all',
+                       optimizer='scipy'):
+
+        """Q optimization step for several initial midsurfaces at once, against the same target.
+
+            The midsurfaces are stacked into one parameter tensor. Shooting and currents kernels are evaluated
+            for all of them in the same block-diagonal reductions (see kernels.segments), and the target terms are
+            shared. The sum of the losses is optimized: it is separable, so each midsurface converges to its own
+            optimum, but the line search is common and the iterates differ from separate optimizeQ runs. Qopt and
+            Wopt are set to the result with the lowest loss.
+
+            Args:
+                sources (list): initial midsurfaces, points arranged as grids as for the constructor; downsampled
+                    to the m x n grid of this object
+                w (torch tensor or list): initial widths, shared or one per midsurface
+                sigmacurrs, sigmadiffs, sigmaw, gamma, beta, iters, theta, compress, nt, shooting, hamiltonian,
+                history, optimizer: as in optimizeQ
+
+            Returns:
+                qreslists (list): for each midsurface, the list of shot midsurfaces (as returned by optimizeQ)
+                wreslists (list): for each midsurface, the list of widths
+                losses (torch tensor): final loss of each midsurface
+        """
+
+        B = len(sources)
+        if not isinstance(w, (list, tuple)):
+            w = [w] * B
+
+        Fjoined, facemap = mesh.joinedTopology(self.FS, self.m, self.n)
+
+        Q = torch.cat([mesh.meshSource(mesh.downsample(source, self.m, self.n))[0] for source in sources])
+        q0 = Q.detach().to(dtype=self.torchdtype, device=self.torchdeviceId).requires_grad_(True)
+        Fjoined = Fjoined.clone().detach().to(dtype=torch.long, device=self.torchdeviceId)
+        w0 = torch.cat([wb.reshape(-1, 1) for wb in w]).detach().to(dtype=self.torchdtype,
+                                                                  device=self.torchdeviceId).requires_grad_(True)
+        VH = self.VH.clone().detach().to(dtype=self.torchdtype, device=self.torchdeviceId)
+        FH = self.FH.clone().detach().to(dtype=torch.long, device=self.torchdeviceId)
+        batch = torch.arange(B, device=self.torchdeviceId).repeat_interleave(self.m * self.n)
+        ranges = kernels.segments(batch)
+
+        target = self.targetCurrents(self.VH, self.FH, sigmacurrs, theta, compress)
+        dataloss = self.lossHippSurfQ(Fjoined, facemap, VH, FH, self.sumGaussLinKernel(sigmacurrs), target, B)
+        loss = self.TotalLossIntegratedQ(self.sumGaussKernel(sigmadiffs, ranges), self.GaussKernel(sigmaw, ranges),
+                                         dataloss, gamma=gamma, beta=beta, nt=nt, shooting=shooting,
+                                         hamiltonian=hamiltonian, batch=batch)
 
-        """W optimization (nonsymmetric)"""
+        pa = torch.zeros(q0.numel() + w0.numel(), dtype=self.torchdtype, device=self.torchdeviceId)
 
-        Fjoined = mesh.joinFlip(self.FS, self.m, self.n)
-        facemap = mesh.incidentFaceMap(2 * self.m * self.n, Fjoined)
+        obj = Optimization.PytorchObjectiveQ(loss, pa, q0, w0, self.torchdtype, self.torchdeviceId, history)
+
+        if optimizer == 'torch':
+            Optimization.minimizeTorch(obj, iters)
+        else:
+            minimize(obj.fun, obj.x0, method='L-BFGS-B', jac=obj.jac, callback=obj.callback, options={'disp': True, 'maxiter': iters})
+
+        if not obj.stored:
+            obj.store()
+
+        qreslists = [list(qs) for qs in zip(*[q.chunk(B) for q in obj.qlist])]
+        wreslists = [list(ws) for ws in zip(*[w.cpu().chunk(B) for w in obj.wlist])]
+        losses = obj.last['losses'].cpu()
+
+        for b in range(B):
+            print("start %d: loss = %.2f" % (b, losses[b]))
+
+        best = int(losses.argmin())
+        self.Qopt = qreslists[best][-1]
+        self.Wopt = wreslists[best][-1]
+
+        return qreslists, wreslists, losses
+
+    def optimizeW(self, wu, wl, sigmacurrs, sigmaws, gamma=1, beta=1, iters=50, theta=None, compress=None, history='all',
+                  optimizer='scipy'):
+
+        """W optimization (nonsymmetric), theta, compress, history and optimizer as in optimizeQ"""
+
+        Fjoined, facemap = mesh.joinedTopology(self.FS, self.m, self.n)
 
         q0 = self.Qopt.clone().detach().to(dtype=self.torchdtype, device=self.torchdeviceId).requires_grad_(True)
         Fjoined = Fjoined.clone().detach().to(dtype=torch.long, device=self.torchdeviceId)
@@ -540,7 +1125,8 @@ class Optimization:
         VH = self.VH.clone().detach().to(dtype=self.torchdtype, device=self.torchdeviceId)
         FH = self.FH.clone().detach().to(dtype=torch.long, device=self.torchdeviceId)
 
-        dataloss = self.lossHippSurfW(Fjoined, facemap, VH, FH, self.sumGaussLinKernel(sigmacurrs))
+        target = self.targetCurrents(self.VH, self.FH, sigmacurrs, theta, compress)
+        dataloss = self.lossHippSurfW(Fjoined, facemap, VH, FH, self.sumGaussLinKernel(sigmacurrs), target)
 
         loss = self.TotalLossW(self.sumGaussKernel(sigmaws), dataloss, gamma, beta)
 
@@ -548,15 +1134,19 @@ class Optimization:
         b0 = torch.zeros(wl0.shape, dtype=self.torchdtype, device=self.torchdeviceId, requires_grad=True)
         ab = torch.cat((a0.flatten(), b0.flatten()))
 
-        obj = Optimization.PytorchObjectiveW(loss, ab, q0, wu0, wl0, self.torchdtype, self.torchdeviceId)
+        obj = Optimization.PytorchObjectiveW(loss, ab, q0, wu0, wl0, self.torchdtype, self.torchdeviceId, history)
 
-        res = minimize(obj.fun, obj.x0, method='L-BFGS-B', jac=obj.jac, callback=obj.callback,
-                       options={'disp': True, 'maxiter': iters})
+        if optimizer == 'torch':
+            Optimization.minimizeTorch(obj, iters)
+        else:
+            minimize(obj.fun, obj.x0, method='L-BFGS-B', jac=obj.jac, callback=obj.callback,
+                     options={'disp': True, 'maxiter': iters})
 
-        sigmaws_cpu = [sigmaw.cpu() for sigmaw in sigmaws]
+        if not obj.stored:
+            obj.store()
 
-        wureslist = [wu0.cpu() + self.sumGaussKernel(sigmaws_cpu)(q0.cpu(), q0.cpu(), arestens.cpu()) for arestens in obj.alist]
-        wlreslist = [wl0.cpu() + self.sumGaussKernel(sigmaws_cpu)(q0.cpu(), q0.cpu(), brestens.cpu()) for brestens in obj.blist]
+        wureslist = [wutens.cpu() for wutens in obj.wulist]
+        wlreslist = [wltens.cpu() for wltens in obj.wllist]
 
         self.Wuopt = wureslist[-1]
         self.Wlopt = wlreslist[-1]
@@ -573,8 +1163,7 @@ class Optimization:
     def joinedsurfaceFigure(self, Q, w, color='Blues'):
         Qd = mesh.doubleQ(Q)
 
-        Fjoined = mesh.joinFlip(self.FS, self.m, self.n)
-        facemap = mesh.incidentFaceMap(2 * Q.shape[0], Fjoined)
+        Fjoined, facemap = mesh.joinedTopology(self.FS, self.m, self.n)
 
         VS = mesh.generateSourceULW(Qd.cpu(), w.flatten().cpu(), Fjoined.cpu(), facemap)
 
@@ -586,8 +1175,7 @@ class Optimization:
     def joinedsurfaceFigureNonsymm(self, Q, wu, wl, color='Blues'):
         Qd = mesh.doubleQ(Q)
 
-        Fjoined = mesh.joinFlip(self.FS, self.m, self.n)
-        facemap = mesh.incidentFaceMap(2 * Q.shape[0], Fjoined)
+        Fjoined, facemap = mesh.joinedTopology(self.FS, self.m, self.n)
 
         VS = mesh.generateSourceULnonsymm(Qd.cpu(), wu.flatten().cpu(), wl.flatten().cpu(), Fjoined.cpu(), facemap)
 
@@ -653,6 +1241,7 @@ class Optimization:
         dim = 50
         while num_s > 0:
             dim = 2*dim - 1
+            num_s -= 1
         return dim
 
     def unfold(self, Q, wu, wl):
@@ -3,6 +3,10 @@ import numpy as np
 import pandas as pd
 from io import BytesIO
 import os
+import json
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import nibabel as nib
 from nibabel.affines import apply_affine
 from matplotlib import pyplot as plt
@@ -12,6 +16,118 @@ import pickle
 import plotly
 import plotly.graph_objs as go
 
+def extractVoxels(fname, rc_axis = 0, min = None, max = None):
+    """Read binary data from single file and return the nonzero voxels, optionally restricted to a range of slices.
+
+        Only slices min to max (inclusive) along rc_axis are read from the image, through its proxy.
+
+        Args:
+            fname (str): name of file with binary data
+            rc_axis (int): axis along which the slices are taken
+            min (int): first slice; None to start at the first slice of the volume
+            max (int): last slice; None to end at the last slice of the volume
+
+        Returns:
+            ijk (numpy array): voxel space coordinates of the nonzero voxels (one row per voxel)
+            ras (numpy array): RAS coordinates of the nonzero voxels
+            affine (numpy array): image affine matrix
+    """
+
+    img = nib.load(fname)
+
+    slicer = [slice(None)] * len(img.shape)
+    slicer[rc_axis] = slice(min, None if max is None else max + 1)
+
+    data = np.asanyarray(img.dataobj[tuple(slicer)])
+    data = data.reshape(data.shape[:3])
+
+    #Voxel space coordinates
+    ijk = np.transpose(np.nonzero(data))
+    if min is not None:
+        ijk[:, rc_axis] += min
+
+    #RAS coordinate conversion, for all voxels at once
+    ras = ijk.dot(abs(img.affine[:3, :3]).transpose()) + img.affine[:3, 3]
+
+    return ijk, ras, img.affine
+
+def saveColumnar(path, data, data_ras):
+    """Store voxel and RAS point cloud dataframes as contiguous arrays that can be memory-mapped.
+
+        Args:
+            path (str): directory to write (created if needed)
+            data (pandas): dataframe of Cartesian data in voxel space
+            data_ras (pandas): dataframe of Cartesian data in RAS space
+    """
+
+    # Write into a temporary directory first so that an interrupted write never looks like a complete one
+    tmp = path.rstrip('/') + '.tmp%d' % os.getpid()
+    os.makedirs(tmp, exist_ok = True)
+
+    try:
+        np.save(os.path.join(tmp, 'voxel.npy'), np.ascontiguousarray(data[[0, 1, 2]].values, dtype = np.int32))
+        np.save(os.path.join(tmp, 'ras.npy'), np.ascontiguousarray(data_ras[[0, 1, 2]].values, dtype = np.float32))
+
+        categories = []
+        if 'label' in data_ras:
+            labels = pd.Categorical(data_ras['label'])
+            categories = [str(c) for c in labels.categories]
+            np.save(os.path.join(tmp, 'labels.npy'), labels.codes.astype(np.int8))
+
+        with open(os.path.join(tmp, 'meta.json'), 'w') as output:
+            json.dump({'categories': categories}, output)
+
+        # Replace an earlier point cloud, columnar or pickled by older versions
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors = True)
+        raise
+
+def loadColumnar(path, system = "RAS", mmap = True):
+    """Load a point cloud dataframe written by saveColumnar.
+
+        Args:
+            path (str): directory written by saveColumnar
+            system (str): coordinate system to load (voxel or RAS)
+            mmap (bool): memory-map the coordinate arrays instead of reading them
+
+        Returns:
+            data (pandas): dataframe of Cartesian data (with a categorical label column if labels were stored)
+    """
+
+    mmap_mode = 'r' if mmap else None
+    coords = np.load(os.path.join(path, 'ras.npy' if system == "RAS" else 'voxel.npy'), mmap_mode = mmap_mode)
+    data = pd.DataFrame(coords, copy = False)
+
+    with open(os.path.join(path, 'meta.json'), 'r') as input:
+        meta = json.load(input)
+
+    if meta['categories']:
+        codes = np.load(os.path.join(path, 'labels.npy'), mmap_mode = mmap_mode)
+        data['label'] = pd.Categorical.from_codes(codes, categories = meta['categories'])
+
+    return data
+
+def _cacheKey(fnames, min, max, rc_axis):
+    """Content address of a point cloud: input files with their size and modification time, slice range and axis"""
+
+    files = []
+    for fname in fnames:
+        # Analyze images keep their header in a separate file
+        for f in [fname, os.path.splitext(fname)[0] + '.hdr']:
+            if os.path.exists(f):
+                st = os.stat(f)
+                files.append([os.path.abspath(f), st.st_size, st.st_mtime])
+
+    key = json.dumps([files, min, max, rc_axis])
+
+    return hashlib.sha1(key.encode()).hexdigest()
+
 class PointCloud:
     """For reading binary point cloud data and storing as Cartesian coordinates.
 
@@ -19,6 +135,10 @@ class PointCloud:
         rawdatapath (str): path name containing binary data segmentation files
         combined (bool): True if rawdatapath is a single file of combined segmentations outputted from
                         Daniel's combine.m function; False otherwise
+        rc_axis (int): axis along which the slices are taken
+        max_workers (int): number of label files loaded concurrently when data is not combined; None loads them
+                        one after another
+        pool (str): "thread" or "process" pool used when max_workers is set
 
     Attributes:
         path (str): stores rawdatapath
@@ -27,41 +147,43 @@ class PointCloud:
         abc (arra): translation part of image affine matrix (for performing conversion to RAS coordinates)
         cartesian_data (pandas): dataframe storing cartesian data in voxel index space
         cartesian_data_ras (pandas): dataframe storing cartesian data in RAS coordinates
+        img_files (list): names of the label files read when data is not combined, in label code order
 
     """
 
 
 
-    def __init__(self, rawdatapath, combined = True, rc_axis = 0):
+    img_files = ['ca1', 'ca2', 'ca3', 'presubiculum', 'subiculum', 'parasubiculum']
+
+    def __init__(self, rawdatapath, combined = True, rc_axis = 0, max_workers = None, pool = "thread"):
         self.path = rawdatapath
         self.comb = combined
         self.rc_axis = rc_axis
+        self.max_workers = max_workers
+        self.pool = pool
 
-    def _toCartesian(self, fname):
+    def _toCartesian(self, fname, min = None, max = None):
         """Read binary data from single file and store in Cartesian space
 
             Args:
                 fname: name of file with binary data
+                min (int): first slice to read along rc_axis; None to start at the first slice of the volume
+                max (int): last slice to read along rc_axis; None to end at the last slice of the volume
 
             Returns:
                 data_df: dataframe of Cartesian data in voxel space
                 data_df_ras: dataframe of Cartesian data in RAS space
         """
 
-        img = nib.load(fname)
-        data = img.get_data()
-
-        #Voxel space coordinates
-        data_all = np.array(np.nonzero(data))
+        ijk, ras, affine = extractVoxels(fname, self.rc_axis, min, max)
 
         #RAS coordinate conversion
-        self._M = abs(img.affine[:3, :3])
-        self._abc = img.affine[:3, 3]
-        ras = self._M.dot(data_all[:-1]) + np.tile(self._abc, (data_all.shape[1], 1)).transpose()
+        self._M = abs(affine[:3, :3])
+        self._abc = affine[:3, 3]
 
         #Store as pandas dataframes
-        data_df = pd.DataFrame(np.transpose(data_all))[[0, 1, 2]]
-        data_df_ras = pd.DataFrame(np.transpose(ras))
+        data_df = pd.DataFrame(ijk)
+        data_df_ras = pd.DataFrame(ras)
 
         return data_df, data_df_ras
 
@@ -74,29 +196,34 @@ class PointCloud:
                 data_img_df (pandas): Voxel space Cartesian data from desired section
                 data_img_ras_df (pandas): RAS space Cartesian data from desired section
         """
-        img_files = ['ca1', 'ca2', 'ca3', 'presubiculum','subiculum','parasubiculum']
-
-        #Temporary holding lists for data from each file
-        data_img_list = []
-        data_img_ras_list = []
-
-        #For each file, convert to Cartesian and append to list
-        for img in img_files:
-            data_df, data_ras_df = self._toCartesian(self.path + img + '.img')
-            data_df['label'] = img
-            data_ras_df['label'] = img
-            data_img_list.append(data_df)
-            data_img_ras_list.append(data_ras_df)
-
-        #Concatenate dataframes in lists
-        data_img_df = pd.concat(data_img_list, ignore_index = True)
-        data_img_ras_df = pd.concat(data_img_ras_list, ignore_index = True)
-        data_img_df = data_img_df.loc[(data_img_df[self.rc_axis] >= min) & (data_img_df[self.rc_axis] <= max)]
-        data_img_ras_df = data_img_ras_df.loc[data_img_df.index]
+
+        #Only the desired section of each file is read
+        fnames = [self.path + img + '.img' for img in self.img_files]
+        n = len(fnames)
+
+        if self.max_workers:
+            #Files are loaded concurrently; map keeps the results in file order
+            Executor = ProcessPoolExecutor if self.pool == "process" else ThreadPoolExecutor
+            with Executor(max_workers = self.max_workers) as executor:
+                extracted = list(executor.map(extractVoxels, fnames, [self.rc_axis] * n, [min] * n, [max] * n))
+        else:
+            extracted = [extractVoxels(fname, self.rc_axis, min, max) for fname in fnames]
+
+        self._M = abs(extracted[-1][2][:3, :3])
+        self._abc = extracted[-1][2][:3, 3]
+
+        #Labels are stored as int8 category codes
+        codes = np.repeat(np.arange(len(self.img_files), dtype = np.int8), [ijk.shape[0] for ijk, ras, affine in extracted])
+        labels = pd.Categorical.from_codes(codes, categories = self.img_files)
+
+        data_img_df = pd.DataFrame(np.vstack([ijk for ijk, ras, affine in extracted]))
+        data_img_ras_df = pd.DataFrame(np.vstack([ras for ijk, ras, affine in extracted]))
+        data_img_df['label'] = labels
+        data_img_ras_df['label'] = labels
 
         return data_img_df, data_img_ras_df
 
-    def Cartesian(self, min, max, system = "voxel"):
+    def Cartesian(self, min, max, system = "voxel", cache_dir = None):
         """
         Public method invoked by user to perform conversion from binary data to Cartesian space.
 
@@ -104,15 +231,32 @@ class PointCloud:
                 xmin (int): Voxel space x-coordinate of first slice in desired section
                 xmax (int): Voxel space x-coordinate of last slice in desired section
                 system (str): specify coordinate system (voxel or RAS); default voxel
+                cache_dir (str): if given, results are stored in (and reloaded from) this directory, keyed on the
+                                input files, their modification times, the slice range and rc_axis
+
+            With cache_dir, the data is always returned as loaded from the cache, computed in this call or not:
+            read-only memory-mapped arrays, int32 voxel and float32 RAS coordinates (see saveColumnar). Without it,
+            coordinates are int64 and float64.
         """
 
-        if self.comb:
-            data, data_ras = self._toCartesian(self.path)
-            self.cartesian_data = data.loc[(data[self.rc_axis] >= min) & (data[self.rc_axis] <= max)]
-            self.cartesian_data_ras = data_ras.loc[self.cartesian_data.index]
+        if cache_dir is not None:
+            fnames = [self.path] if self.comb else [self.path + img + '.img' for img in self.img_files]
+            cached = os.path.join(cache_dir, _cacheKey(fnames, min, max, self.rc_axis))
 
-        else:
-            self.cartesian_data, self.cartesian_data_ras = self._joinCartesian(min, max)
+        if cache_dir is None or not os.path.isdir(cached):
+            if self.comb:
+                self.cartesian_data, self.cartesian_data_ras = self._toCartesian(self.path, min, max)
+
+            else:
+                self.cartesian_data, self.cartesian_data_ras = self._joinCartesian(min, max)
+
+            if cache_dir is not None:
+                saveColumnar(cached, self.cartesian_data, self.cartesian_data_ras)
+
+        # Reload what was just cached too, so that results do not depend on whether the cache was hit
+        if cache_dir is not None:
+            self.cartesian_data = loadColumnar(cached, system = "voxel")
+            self.cartesian_data_ras = loadColumnar(cached, system = "RAS")
 
         if system == "voxel":
             return self.cartesian_data
@@ -244,5 +388,4 @@ if __name__ == "__main__":
     pc_uc.Cartesian(int(sys.argv[2]), int(sys.argv[3]))
     pc_uc.plot(system = 'RAS')
 
-    with open('hippocampus/thicknessMap/dataframes/brain' + sys.argv[1] + '/cartesian_pc_ras', 'wb') as output:
-        pickle.dump(pc_uc.cartesian_data_ras, output)
\ No newline at end of file
+    saveColumnar('hippocampus/thicknessMap/dataframes/brain' + sys.argv[1] + '/cartesian_pc_ras', pc_uc.cartesian_data, pc_uc.cartesian_data_ras)
\ No newline at end of file
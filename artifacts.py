@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import numpy as np
+import torch
+
+"""Content-addressed store for the results of pipeline stages.
+
+    A stage is a function of the results of other stages and of plain parameters. Its key hashes its name, the keys
+    of the stages it depends on, its parameters (tensors and arrays by content) and its input files (by path, size
+    and modification time, as the point cloud cache). Results are pickled under their key and evaluated lazily:
+    a stage whose result is on disk is loaded only when a stage that has to run needs it, so changing a parameter
+    reruns that stage and the stages downstream of it only.
+
+    Example:
+        store = Store('out/stages')
+        target = store.stage('target', mesh.meshTargetPyramid, files=[img], img_file=img, first_slice=0, last_slice=10)
+        fit = store.stage('fit', fitFunction, target, sigma=1.0)
+        result = fit.value
+"""
+
+
+def _encode(obj):
+    """JSON encoding of the parameter types json does not know"""
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach().cpu().numpy()
+
+    if isinstance(obj, np.ndarray):
+        data = np.ascontiguousarray(obj)
+        return ['array', str(data.dtype), list(data.shape), hashlib.sha1(data.tobytes()).hexdigest()]
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError('Cannot hash stage parameter of type %s' % type(obj).__name__)
+
+
+def fileKey(path):
+    """Path, size and modification time of a file, with the header of an Analyze image"""
+    files = []
+    for f in [path, os.path.splitext(path)[0] + '.hdr']:
+        if os.path.exists(f):
+            st = os.stat(f)
+            files.append([os.path.abspath(f), st.st_size, st.st_mtime])
+
+    if not files:
+        raise FileNotFoundError(path)
+
+    return files
+
+
+class Store:
+    """Directory of stage results.
+
+        Args:
+            root (str): directory of the results, created if needed
+            rerun (list): names of stages run even if their result is on disk (e.g. after a code change), with the
+                          stages downstream of them
+    """
+
+    def __init__(self, root, rerun=()):
+        self.root = root
+        self.rerun = set(rerun)
+        os.makedirs(root, exist_ok=True)
+
+    def stage(self, name, fn, *deps, files=(), **params):
+        """Stage computing fn(*[d.value for d in deps], **params).
+
+            Args:
+                name (str): stage name, unique in the pipeline
+                fn (function): computation of the stage, its result has to be picklable
+                deps (Artifact): stages whose results are the positional arguments of fn
+                files (list): input files read by fn, hashed with fileKey
+                params: keyword arguments of fn, hashed by value
+
+            Returns:
+                artifact (Artifact): the stage, evaluated on access of artifact.value
+        """
+
+        return Artifact(self, name, fn, deps, files, params)
+
+
+class Artifact:
+    """Result of a stage, computed or loaded on first access of value"""
+
+    def __init__(self, store, name, fn, deps, files, params):
+        key = json.dumps([name, [d.key for d in deps], [fileKey(f) for f in files], params], default=_encode,
+                         sort_keys=True)
+
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+        self.params = params
+        self.key = hashlib.sha1(key.encode()).hexdigest()
+        self.path = os.path.join(store.root, name + '-' + self.key)
+        self.stale = name in store.rerun or any(d.stale for d in deps)
+
+    def cached(self):
+        return not self.stale and os.path.exists(self.path)
+
+    @property
+    def value(self):
+        if not hasattr(self, '_value'):
+            if self.cached():
+                with open(self.path, 'rb') as input:
+                    self._value = pickle.load(input)
+                print('Stage %s: loaded %s' % (self.name, self.path))
+
+            else:
+                start = time.time()
+                self._value = self.fn(*[d.value for d in self.deps], **self.params)
+
+                # Write and rename, so that an interrupted run never leaves a truncated result behind
+                with open(self.path + '.tmp', 'wb') as output:
+                    pickle.dump(self._value, output)
+                os.replace(self.path + '.tmp', self.path)
+                print('Stage %s: computed in %.1f s' % (self.name, time.time() - start))
+
+        return self._value
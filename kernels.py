@@ -0,0 +1,520 @@
+
+import numpy as np
+import torch
+
+try:
+    from pykeops.torch import Genred
+except ImportError:
+    Genred = None
+
+
+def gammas(sigmas, dtype=torch.float32, device='cpu'):
+    """Vector of 1 / sigma^2 for a list of (scalar or one-element tensor) sigmas"""
+    return torch.tensor([1 / (float(s) * float(s)) for s in sigmas], dtype=dtype, device=device)
+
+
+def segments(batch):
+    """Ranges [start, end) of the rows of each batch, (B, 2), from a sorted batch index.
+
+        Kernels and reductions given these ranges are block diagonal: several independent point sets stacked
+        are reduced each on its own, in a single call.
+    """
+    counts = torch.bincount(batch)
+    ends = torch.cumsum(counts, 0)
+    return torch.stack((ends - counts, ends), 1)
+
+
+class KeOpsBackend:
+    """Kernel reductions compiled with KeOps (GPU, or CPU when a compiler is available).
+
+        All kernels are sums of Gaussians exp(-gamma_s |x - y|^2) over a vector of gammas, evaluated inside a
+        single reduction over j.
+    """
+
+    name = 'keops'
+
+    def __init__(self):
+        if Genred is None:
+            raise ImportError("pykeops is not installed, use the 'torch' kernel backend")
+
+        self.routines = {}
+
+    def __reduce__(self):
+        return (KeOpsBackend, ())
+
+    def routine(self, formula, aliases):
+        """Compile (once) and return the reduction over j of formula"""
+        key = (formula, tuple(aliases))
+        if key not in self.routines:
+            self.routines[key] = Genred(formula, aliases, reduction_op='Sum', axis=1)
+
+        return self.routines[key]
+
+    @staticmethod
+    def blockDiagonal(ranges):
+        """KeOps block-sparse ranges of a block-diagonal reduction (see segments), None for a dense one"""
+        if ranges is None:
+            return None
+
+        r = ranges.to(dtype=torch.int32).contiguous()
+        slices = torch.arange(1, r.shape[0] + 1, dtype=torch.int32, device=r.device)
+        return r, slices, r, r, slices, r
+
+    def gauss(self, gamma, ranges=None):
+        """Multi-scale Gaussian kernel K(x, y, b) = sum_j sum_s exp(-gamma_s |x_i - y_j|^2) b_j
+
+            Args:
+                gamma (torch tensor): vector of 1 / sigma^2
+                ranges (torch tensor): blocks of stacked point sets, the kernel is then block diagonal (see
+                    segments)
+
+            Returns:
+                K (func): kernel function, with its gamma, ranges and backend as attributes
+        """
+
+        blocks = self.blockDiagonal(ranges)
+
+        def K(x, y, b):
+            routine = self.routine('Sum(Exp(-G * SqDist(X, Y))) * B',
+                                   ['G = Pm(%d)' % gamma.shape[0], 'X = Vi(%d)' % x.shape[1],
+                                    'Y = Vj(%d)' % y.shape[1], 'B = Vj(%d)' % b.shape[1]])
+            return routine(gamma.to(dtype=x.dtype, device=x.device), x, y, b, backend='auto', ranges=blocks)
+
+        K.gamma, K.ranges, K.backend = gamma, ranges, self
+        return K
+
+    def gaussLin(self, gamma):
+        """Multi-scale currents kernel K(x, y, u, v, b) = sum_j sum_s exp(-gamma_s |x_i - y_j|^2) <u_i, v_j> b_j
+
+            Args:
+                gamma (torch tensor): vector of 1 / sigma^2
+
+            Returns:
+                K (func): kernel function
+        """
+
+        def K(x, y, u, v, b):
+            routine = self.routine('Sum(Exp(-G * SqDist(X, Y))) * (U | V) * B',
+                                   ['G = Pm(%d)' % gamma.shape[0], 'X = Vi(3)', 'Y = Vj(3)', 'U = Vi(3)', 'V = Vj(3)',
+                                    'B = Vj(%d)' % b.shape[1]])
+            return routine(gamma.to(dtype=x.dtype, device=x.device), x, y, u, v, b, backend='auto')
+
+        return K
+
+    def currents(self, gamma, x, y, u, v, grad=False, ranges=None):
+        """Reduction over j of the currents kernel k(x_i, y_j) <u_i, v_j>.
+
+            With grad, the same pass also returns sum_j k v_j and sum_j sum_s gamma_s exp(-gamma_s |x_i - y_j|^2)
+            <u_i, v_j> (x_i - y_j), from which the gradients of the currents distance are assembled.
+
+            Args:
+                gamma (torch tensor): vector of 1 / sigma^2
+                x, y (torch tensor): centroids
+                u, v (torch tensor): normals
+                grad (bool): also return the gradient sums
+                ranges (torch tensor): blocks of stacked point sets, for a block-diagonal reduction (see segments)
+
+            Returns:
+                out (torch tensor): (N, 1), or (N, 7) with grad
+        """
+
+        aliases = ['G = Pm(%d)' % gamma.shape[0], 'X = Vi(3)', 'Y = Vj(3)', 'U = Vi(3)', 'V = Vj(3)']
+        if grad:
+            formula = 'Concat(Sum(Exp(-G * SqDist(X, Y))) * (U | V), ' \
+                      'Concat(Sum(Exp(-G * SqDist(X, Y))) * V, ((G | Exp(-G * SqDist(X, Y))) * (U | V)) * (X - Y)))'
+        else:
+            formula = 'Sum(Exp(-G * SqDist(X, Y))) * (U | V)'
+
+        return self.routine(formula, aliases)(gamma, x, y, u, v, backend='auto', ranges=self.blockDiagonal(ranges))
+
+
+class TorchBackend:
+    """Dense kernel reductions in plain torch, for nodes without KeOps.
+
+        The N x M pairs are processed in tiles of at most block_size x block_size, so memory stays bounded in
+        the forward pass. The gauss and gaussLin kernels are differentiated by autograd, which keeps the tiles of
+        the graph alive; they are meant for midsurface-sized point sets. The currents reductions used by
+        currents_distance run outside of autograd and stay bounded on large targets.
+
+        Args:
+            block_size (int): tile size along both axes
+            num_threads (int): torch CPU threads; the thread count is process-wide, getBackend sets it once when it
+                creates the backend, and only if given (torch's default, or OMP_NUM_THREADS, otherwise)
+    """
+
+    name = 'torch'
+
+    def __init__(self, block_size=2048, num_threads=None):
+        self.block_size = block_size
+        self.num_threads = num_threads
+
+    def __reduce__(self):
+        return (TorchBackend, (self.block_size, self.num_threads))
+
+    @staticmethod
+    def weights(gamma, x, y, grad=False):
+        """Sum of Gaussians over the gammas on one tile, and sum of gamma_s exp(...) with grad"""
+        D = ((x[:, None, :] - y[None, :, :]) ** 2).sum(-1)
+        E = [torch.exp(-g * D) for g in gamma]
+        k = sum(E)
+        if grad:
+            return k, sum(g * e for g, e in zip(gamma, E))
+
+        return k
+
+    def reduce(self, x, y, f, dim, ranges=None):
+        """Sum over j of f(i tile, j tile), tile by tile; within each block of ranges only (see segments)"""
+        if ranges is None:
+            blocks = [(0, x.shape[0], 0, y.shape[0])]
+        else:
+            blocks = [(a, b, a, b) for a, b in ranges.tolist()]
+
+        rows = []
+        for i0, i1, j0, j1 in blocks:
+            for i in range(i0, i1, self.block_size):
+                I = slice(i, min(i + self.block_size, i1))
+                out = torch.zeros([I.stop - I.start, dim], dtype=x.dtype, device=x.device)
+                for j in range(j0, j1, self.block_size):
+                    out = out + f(I, slice(j, min(j + self.block_size, j1)))
+                rows.append(out)
+
+        return torch.cat(rows)
+
+    def gauss(self, gamma, ranges=None):
+        """Multi-scale Gaussian kernel K(x, y, b) = sum_j sum_s exp(-gamma_s |x_i - y_j|^2) b_j
+
+            Args:
+                gamma (torch tensor): vector of 1 / sigma^2
+                ranges (torch tensor): blocks of stacked point sets, the kernel is then block diagonal (see
+                    segments)
+
+            Returns:
+                K (func): kernel function, with its gamma, ranges and backend as attributes
+        """
+
+        def K(x, y, b):
+            g = gamma.to(dtype=x.dtype, device=x.device)
+            return self.reduce(x, y, lambda I, J: self.weights(g, x[I], y[J]) @ b[J], b.shape[1], ranges)
+
+        K.gamma, K.ranges, K.backend = gamma, ranges, self
+        return K
+
+    def gaussLin(self, gamma):
+        """Multi-scale currents kernel K(x, y, u, v, b) = sum_j sum_s exp(-gamma_s |x_i - y_j|^2) <u_i, v_j> b_j
+
+            Args:
+                gamma (torch tensor): vector of 1 / sigma^2
+
+            Returns:
+                K (func): kernel function
+        """
+
+        def K(x, y, u, v, b):
+            g = gamma.to(dtype=x.dtype, device=x.device)
+            return self.reduce(x, y, lambda I, J: (self.weights(g, x[I], y[J]) * (u[I] @ v[J].t())) @ b[J], b.shape[1])
+
+        return K
+
+    def currents(self, gamma, x, y, u, v, grad=False, ranges=None):
+        """Reduction over j of the currents kernel k(x_i, y_j) <u_i, v_j>, see KeOpsBackend.currents"""
+
+        def f(I, J):
+            uv = u[I] @ v[J].t()
+            if not grad:
+                return (self.weights(gamma, x[I], y[J]) * uv).sum(1, keepdim=True)
+
+            k, kg = self.weights(gamma, x[I], y[J], grad=True)
+            w = kg * uv
+            return torch.cat(((k * uv).sum(1, keepdim=True), k @ v[J], x[I] * w.sum(1, keepdim=True) - w @ y[J]), 1)
+
+        return self.reduce(x, y, f, 7 if grad else 1, ranges)
+
+
+def _expand(starts, counts):
+    """Indices starts[k] + 0, ..., starts[k] + counts[k] - 1, concatenated over k"""
+    total = int(counts.sum())
+    offsets = torch.cumsum(counts, 0) - counts
+    return torch.repeat_interleave(starts - offsets, counts) + torch.arange(total, device=starts.device)
+
+
+def _octreeLevels(Y, w, lo, size, leaf_size=None, depth=16):
+    """Levels of an octree over the points Y, on the grid of the cube of corner lo and side size.
+
+        Each level is a dict of cell centers (w-weighted), radii, counts, members grouped by cell (from mstart)
+        and, except for the last level, children grouped by parent (from cstart). Points outside of the cube
+        fall in the border cells, the radii stay exact. Subdivision stops after depth levels or, with leaf_size,
+        once no cell has more than leaf_size points.
+    """
+
+    levels = []
+    ids = np.zeros(len(Y), dtype=np.int64)
+    for l in range(depth):
+        if l > 0:
+            g = np.clip(((Y - lo) / size * 2 ** l).astype(np.int64), 0, 2 ** l - 1)
+            _, ids_l = np.unique((g[:, 0] << (2 * l)) | (g[:, 1] << l) | g[:, 2], return_inverse=True)
+            ids_l = ids_l.ravel()
+            parent = np.zeros(ids_l.max() + 1, dtype=np.int64)
+            parent[ids_l] = ids
+            ids = ids_l
+
+            prev = levels[-1]
+            prev['children'] = np.argsort(parent, kind='stable')
+            prev['nchild'] = np.bincount(parent, minlength=len(prev['count']))
+            prev['cstart'] = np.cumsum(prev['nchild']) - prev['nchild']
+
+        count = np.bincount(ids)
+        wsum = np.bincount(ids, w)
+        center = np.stack([np.bincount(ids, w * Y[:, k]) for k in range(3)], 1)
+        mean = np.stack([np.bincount(ids, Y[:, k]) for k in range(3)], 1) / count[:, None]
+        center = np.where(wsum[:, None] > 0, center / np.maximum(wsum, 1e-300)[:, None], mean)
+        radius = np.zeros(len(count))
+        np.maximum.at(radius, ids, np.linalg.norm(Y - center[ids], axis=1))
+
+        levels.append({'ids': ids, 'center': center, 'radius': radius, 'count': count,
+                       'members': np.argsort(ids, kind='stable'), 'mstart': np.cumsum(count) - count})
+
+        if leaf_size is not None and count.max() <= leaf_size:
+            break
+
+    return levels
+
+
+class CurrentsOctree:
+    """Barnes-Hut approximation of the currents reduction against a fixed (large) target.
+
+        Target face centroids are clustered with an octree, each cell summarized by its |normal|-weighted
+        center, radius and summed normal. Source points are put on an octree over the same grid, and pairs of
+        source and target cells are visited level by level: a pair is skipped when the cells are out of reach of
+        the kernel (exp(-gamma_min (d - rA - rB)^2) < eps), the target cell is used as a single Dirac for the
+        whole source cell when gamma_max rB (2 (d + rA) + rB) <= theta, which bounds the relative error of each
+        kernel value it stands for by exp(theta) - 1, and the cells are opened otherwise. Pairs of cells with at
+        most leaf_size points each are evaluated exactly, as dense blocks.
+
+        Args:
+            CT (torch tensor): target centroids
+            NT (torch tensor): target normals
+            sigmas (list): sigmas of the currents kernel
+            theta (float): accuracy parameter, 0 is exact up to the cutoff
+            leaf_size (int): cells with at most leaf_size points are not opened
+            eps (float): kernel cutoff
+            max_depth (int): maximum octree depth
+            chunk (int): number of kernel values evaluated at once
+
+        Attributes:
+            levels (list): octree levels of the target (see _octreeLevels)
+            Z (torch tensor): cell centers of all levels, as Diracs
+            V (torch tensor): summed normals of the cells
+            pairs (int): number of kernel values evaluated in the last reduction
+    """
+
+    def __init__(self, CT, NT, sigmas, theta=0.5, leaf_size=32, eps=1e-7, max_depth=16, chunk=2 ** 22):
+        self.gamma = gammas(sigmas, dtype=CT.dtype, device=CT.device)
+        self.theta = theta
+        self.leaf_size = leaf_size
+        self.cutoff = (-np.log(eps) / float(self.gamma.min())) ** .5
+        self.chunk = chunk
+        self.CT, self.NT = CT.detach(), NT.detach()
+
+        Y = self.CT.cpu().double().numpy()
+        N = self.NT.cpu().double().numpy()
+        self.lo = Y.min(0)
+        self.size = (Y.max(0) - self.lo).max() * (1 + 1e-9) + 1e-12
+        self.levels = _octreeLevels(Y, np.linalg.norm(N, axis=1), self.lo, self.size, leaf_size, max_depth + 1)
+
+        Z, V, offset = [], [], 0
+        for lev in self.levels:
+            lev['offset'] = offset
+            offset += len(lev['count'])
+            Z.append(lev['center'])
+            V.append(np.stack([np.bincount(lev['ids'], N[:, k]) for k in range(3)], 1))
+        self.Z = torch.as_tensor(np.concatenate(Z)).to(dtype=CT.dtype, device=CT.device)
+        self.V = torch.as_tensor(np.concatenate(V)).to(dtype=CT.dtype, device=CT.device)
+        self.levels = [self.toTorch(lev, CT) for lev in self.levels]
+        self.pairs = 0
+
+    @staticmethod
+    def toTorch(lev, like):
+        return {key: (torch.as_tensor(val).to(device=like.device, dtype=like.dtype if val.dtype.kind == 'f' else None)
+                      if isinstance(val, np.ndarray) else val) for key, val in lev.items()}
+
+    def interactions(self, x):
+        """Interacting pairs of source and target cells.
+
+            Args:
+                x (torch tensor): source points
+
+            Returns:
+                source (list): octree levels of the source points
+                far (list): (level, source cells, target cells) evaluated with the target cell summaries
+                blocks (list): (level, source cells, target cells) evaluated exactly
+        """
+
+        Y = x.detach().cpu().double().numpy()
+        source = [self.toTorch(lev, x) for lev in _octreeLevels(Y, np.ones(len(Y)), self.lo, self.size, depth=len(self.levels))]
+
+        A = torch.zeros(1, dtype=torch.long, device=x.device)
+        B = torch.zeros_like(A)
+        far, blocks = [], []
+        gmax = float(self.gamma.max())
+
+        for l, (sl, tl) in enumerate(zip(source, self.levels)):
+            d = (sl['center'][A] - tl['center'][B]).norm(dim=1)
+            rA, rB = sl['radius'][A], tl['radius'][B]
+
+            # drop pairs out of reach of the kernel, summarize far enough target cells
+            near = d - rA - rB < self.cutoff
+            A, B, d, rA, rB = A[near], B[near], d[near], rA[near], rB[near]
+            summary = gmax * rB * (2 * (d + rA) + rB) <= self.theta
+            far.append((l, A[summary], B[summary]))
+            A, B = A[~summary], B[~summary]
+
+            if l == len(self.levels) - 1:
+                blocks.append((l, A, B))
+                break
+
+            leaf = (sl['count'][A] <= self.leaf_size) & (tl['count'][B] <= self.leaf_size)
+            blocks.append((l, A[leaf], B[leaf]))
+            A, B = A[~leaf], B[~leaf]
+
+            # all pairs of children
+            nA, nB = sl['nchild'][A], tl['nchild'][B]
+            rep = nA * nB
+            t = _expand(torch.zeros_like(rep), rep)
+            nB = torch.repeat_interleave(nB, rep)
+            A = sl['children'][torch.repeat_interleave(sl['cstart'][A], rep) + t // nB]
+            B = tl['children'][torch.repeat_interleave(tl['cstart'][B], rep) + t % nB]
+
+        return source, far, blocks
+
+    @staticmethod
+    def padded(lev, cells):
+        """Members of cells as a padded (cells, max count) index array and its mask"""
+        count = lev['count'][cells]
+        width = int(count.max()) if count.shape[0] > 0 else 0
+        ar = torch.arange(width, device=cells.device)
+        mask = ar[None, :] < count[:, None]
+        idx = (lev['mstart'][cells][:, None] + ar[None, :]).clamp(max=lev['members'].shape[0] - 1)
+
+        return lev['members'][idx], mask
+
+    def currents(self, x, u, grad=False):
+        """Reduction over the target of the currents kernel, with the output layout of KeOpsBackend.currents.
+
+            Args:
+                x (torch tensor): source centroids
+                u (torch tensor): source normals
+                grad (bool): also return the gradient sums
+
+            Returns:
+                out (torch tensor): (N, 1), or (N, 7) with grad
+        """
+
+        gamma = self.gamma.to(x.dtype)
+
+        # dx (P, a, b, 3), uv (P, a, b), vb (P, b, 3) -> per source point sums (P, a, 1 or 7)
+        def terms(dx, uv, vb, mask=None):
+            D = (dx ** 2).sum(-1)
+            E = [torch.exp(-g * D) for g in gamma]
+            k = sum(E)
+            if mask is not None:
+                k = k * mask
+            cols = [(k * uv).sum(-1, keepdim=True)]
+            if grad:
+                w = sum(g * e for g, e in zip(gamma, E)) * uv
+                if mask is not None:
+                    w = w * mask
+                cols += [k @ vb, (w[..., None] * dx).sum(-2)]
+            return torch.cat(cols, -1)
+
+        with torch.no_grad():
+            x, u = x.detach(), u.detach()
+            source, far, blocks = self.interactions(x)
+            out = torch.zeros([x.shape[0], 7 if grad else 1], dtype=x.dtype, device=x.device)
+            self.pairs = 0
+
+            # each source point of the cell against the target cell summary
+            for l, A, B in far:
+                counts = source[l]['count'][A]
+                I = source[l]['members'][_expand(source[l]['mstart'][A], counts)]
+                J = self.levels[l]['offset'] + torch.repeat_interleave(B, counts)
+                self.pairs += I.shape[0]
+                for c in range(0, I.shape[0], self.chunk):
+                    Ic, Jc = I[c:c + self.chunk], J[c:c + self.chunk]
+                    dx = (x[Ic] - self.Z[Jc])[:, None, None, :]
+                    uv = (u[Ic] * self.V[Jc]).sum(1)[:, None, None]
+                    out.index_add_(0, Ic, terms(dx, uv, self.V[Jc][:, None, :])[:, 0])
+
+            # dense blocks of source points against target faces, grouped by size to limit the padding
+            for l, A, B in blocks:
+                if A.shape[0] == 0:
+                    continue
+                nA, nB = source[l]['count'][A], self.levels[l]['count'][B]
+                bucket = torch.ceil(torch.log2(nA.to(torch.float64))) * 64 + torch.ceil(torch.log2(nB.to(torch.float64)))
+                self.pairs += int((nA * nB).sum())
+                for key in torch.unique(bucket):
+                    IA, mA = self.padded(source[l], A[bucket == key])
+                    JB, mB = self.padded(self.levels[l], B[bucket == key])
+                    step = max(1, self.chunk // (IA.shape[1] * JB.shape[1]))
+                    for c in range(0, IA.shape[0], step):
+                        Ic, Jc, mAc, mBc = IA[c:c + step], JB[c:c + step], mA[c:c + step], mB[c:c + step]
+                        xa, yb, vb = x[Ic], self.CT[Jc], self.NT[Jc]
+                        dx = xa[:, :, None, :] - yb[:, None, :, :]
+                        uv = torch.einsum('pad,pbd->pab', u[Ic], vb)
+                        res = terms(dx, uv, vb, mBc[:, None, :].to(x.dtype))
+                        out.index_add_(0, Ic[mAc], res[mAc])
+
+        return out
+
+    def error(self, x, u, samples=256):
+        """Relative error of the approximation against the exact kernel on a random subset of source points.
+
+            Args:
+                x (torch tensor): source centroids
+                u (torch tensor): source normals
+                samples (int): number of source points checked
+
+            Returns:
+                error (float): sum_i |approx_i - exact_i| / sum_i |exact_i| over the sampled points
+        """
+
+        idx = torch.randperm(x.shape[0], generator=torch.Generator().manual_seed(0))[:samples].to(x.device)
+        approx = self.currents(x[idx], u[idx])[:, 0]
+        exact = TorchBackend()
+        exact = exact.currents(self.gamma.to(x.dtype), x[idx].detach(), self.CT, u[idx].detach(), self.NT)[:, 0]
+
+        return float((approx - exact).abs().sum() / exact.abs().sum().clamp(min=1e-30))
+
+
+_backends = {}
+
+
+def getBackend(backend='auto', **kwargs):
+    """Kernel backend from its name. Backends are shared between callers asking for the same configuration.
+
+        Args:
+            backend (str or object): 'keops', 'torch', 'auto' (KeOps if installed, torch otherwise), or a backend
+                instance which is returned as is
+            kwargs: passed to the backend constructor
+
+        Returns:
+            backend (KeOpsBackend or TorchBackend): kernel backend
+    """
+
+    if not isinstance(backend, str):
+        return backend
+
+    if backend == 'auto':
+        backend = 'keops' if Genred is not None else 'torch'
+
+    if backend not in ('keops', 'torch'):
+        raise ValueError("Unknown kernel backend '%s'" % backend)
+
+    key = (backend, tuple(sorted(kwargs.items())))
+    if key not in _backends:
+        _backends[key] = KeOpsBackend(**kwargs) if backend == 'keops' else TorchBackend(**kwargs)
+
+        # The thread count is process-wide: set it once, here, rather than for every backend built or unpickled
+        if kwargs.get('num_threads'):
+            torch.set_num_threads(kwargs['num_threads'])
+
+    return _backends[key]
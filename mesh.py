@@ -1,18 +1,21 @@
 import numpy as np
+import pandas as pd
 import pickle
 from PointCloud import PointCloud
 from Midsurface import Midsurface
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
 import plotly
 import plotly.graph_objs as go
 import plotly.figure_factory as FF
 import nibabel as nib
 
 import math
+import hashlib
 from skimage import measure
 
 import torch
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import sys
 
@@ -65,73 +68,71 @@ def meshSource(S):
 
     return tV, tF
 
-def subdivide(V, F):
+def _subdivideOnce(V, F):
+    """Single level of midpoint subdivision on numpy arrays (see subdivide)"""
+
     nV = V.shape[0]
     nF = F.shape[0]
-    F = F.detach().numpy()
-    V = V.detach().numpy()
-    E = np.vstack([np.transpose(np.vstack([F[:, 0], F[:, 1]])),
-                    np.transpose(np.vstack([F[:, 1], F[:, 2]])),
-                   np.transpose(np.vstack([F[:, 2], F[:, 0]]))
-                  ])
-
-    E = np.sort(E, 1)
-    E = np.unique(E, axis = 0)
-    nE = E.shape[0]
-    VE_idx = np.zeros(nE)
-
-    nV_new = nV + nE
-    nF_new = 4*nF
-
-    V_new = np.zeros((nV_new, 3))
-    F_new = np.zeros((nF_new, 3))
-
-    V_new[0:nV] = V
-    V_count = nV
-
-    for i in range(nF):
-        f = F[i]
-        e1 = [f[0], f[1]]
-        e2 = [f[1], f[2]]
-        e3 = [f[2], f[0]]
-
-        v1 = np.mean(V[e1], axis = 0)
-        v2 = np.mean(V[e2], axis = 0)
-        v3 = np.mean(V[e3], axis = 0)
-
-        e1_idx = np.nonzero((E[:, 0] == min(e1)) & (E[:, 1] == max(e1)))
-        if VE_idx[e1_idx] == 0:
-            V_new[V_count] = v1
-            v1_idx = V_count
-            VE_idx[e1_idx] = v1_idx
-            V_count += 1
-        else:
-            v1_idx = VE_idx[e1_idx]
-
-        e2_idx = np.nonzero((E[:, 0] == min(e2)) & (E[:, 1] == max(e2)))
-        if VE_idx[e2_idx] == 0:
-            V_new[V_count] = v2
-            v2_idx = V_count
-            VE_idx[e2_idx] = v2_idx
-            V_count += 1
-        else:
-            v2_idx = VE_idx[e2_idx]
-
-        e3_idx = np.nonzero((E[:, 0] == min(e3)) & (E[:, 1] == max(e3)))
-        if VE_idx[e3_idx] == 0:
-            V_new[V_count] = v3
-            v3_idx = V_count
-            VE_idx[e3_idx] = v3_idx
-            V_count += 1
-        else:
-            v3_idx = VE_idx[e3_idx]
-
-        F_new[4*i] = [f[0], v1_idx, v3_idx]
-        F_new[4*i + 1] = [f[1], v2_idx, v1_idx]
-        F_new[4*i + 2] = [f[2], v3_idx, v2_idx]
-        F_new[4*i + 3] = [v1_idx, v2_idx, v3_idx]
-
-    return torch.as_tensor(V_new, dtype = torch.float32), torch.as_tensor(F_new, dtype = torch.long)
+
+    # Edges in the order the faces visit them: (f0, f1), (f1, f2), (f2, f0) for every face
+    E = np.sort(np.stack([F[:, [0, 1]], F[:, [1, 2]], F[:, [2, 0]]], axis = 1).reshape(-1, 2), axis = 1)
+
+    # Unique edge table from integer edge keys
+    keys, first, inverse = np.unique(E[:, 0] * nV + E[:, 1], return_index = True, return_inverse = True)
+
+    # Number the midpoints in order of first appearance, as a face-by-face construction would
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+
+    Eunique = np.vstack([keys // nV, keys % nV]).transpose()[order]
+    Emid = np.hstack([Eunique, nV + np.arange(Eunique.shape[0])[:, None]])
+
+    V_new = np.vstack([V, V[Eunique].mean(axis = 1)])
+
+    # Midpoint vertices of the edges (f0, f1), (f1, f2), (f2, f0) of every face
+    mid = nV + rank[inverse.reshape(-1)].reshape(nF, 3)
+    v1, v2, v3 = mid[:, 0], mid[:, 1], mid[:, 2]
+
+    F_new = np.stack([np.vstack([F[:, 0], v1, v3]).transpose(),
+                      np.vstack([F[:, 1], v2, v1]).transpose(),
+                      np.vstack([F[:, 2], v3, v2]).transpose(),
+                      np.vstack([v1, v2, v3]).transpose()], axis = 1).reshape(4*nF, 3)
+
+    Fchild = 4*np.arange(nF)[:, None] + np.arange(4)
+
+    return V_new, F_new, Fchild, Emid
+
+def subdivide(V, F, levels = 1, return_map = False):
+    """Midpoint subdivision: every face is split into four by inserting a vertex at the middle of each edge.
+
+        Args:
+            V (torch tensor): mesh vertices
+            F (torch tensor): mesh faces
+            levels (int): number of successive subdivisions
+            return_map (bool): also return the parent-child mapping of every level
+
+        Returns:
+            V_new (torch tensor): subdivided mesh vertices (the original vertices come first)
+            F_new (torch tensor): subdivided mesh faces (face i is replaced by faces 4i, ..., 4i + 3)
+            maps (list): only if return_map; one (Fchild, Emid) pair per level, where Fchild[i] are the
+                         children of face i and each row of Emid is (parent vertex, parent vertex, midpoint vertex)
+    """
+
+    V = V.detach().cpu().numpy()
+    F = F.detach().cpu().numpy()
+    maps = []
+
+    for i in range(levels):
+        V, F, Fchild, Emid = _subdivideOnce(V, F)
+        maps.append((torch.as_tensor(Fchild, dtype = torch.long), torch.as_tensor(Emid, dtype = torch.long)))
+
+    V_new, F_new = torch.as_tensor(V, dtype = torch.float32), torch.as_tensor(F, dtype = torch.long)
+
+    if return_map:
+        return V_new, F_new, maps
+
+    return V_new, F_new
 
 
 def meshSynthTarget(m, n, a, w):
@@ -225,36 +226,18 @@ def meshSynthTarget(m, n, a, w):
     
     return tV, tF, tVmid, tFmid
     
-def meshTarget(img_file, first_slice, last_slice, system = "voxel", rc_axis = 0, step = 1):
-    """Mesh binary data through marching cubes.
+def _loadSection(img, first_slice, last_slice, rc_axis = 0):
+    """Read slices [first_slice, last_slice) along rc_axis through the image proxy, without loading the whole volume"""
 
-        Args:
-            img_file (str): binary data file
-            first_slice (int): Voxel space x-coordinate of first slice (most anterior) in desired section
-            last_slice (int): Voxel space x-coordinate of last slice (most posterior) in desired section
-            system (str): specify coordinate system (voxel or RAS); default voxel
-
-        Returns:
-            tV (torch tensor): target mesh vertices
-            tF (torch tensor): target mesh faces
-    """
-
-    # Load data
-    fname = img_file
-    img = nib.load(fname)
-    hdr = img.header
-
-    nxi = hdr['dim'][1:4]
+    slicer = [slice(None)] * len(img.shape)
+    slicer[rc_axis] = slice(first_slice, last_slice)
 
+    data = np.asanyarray(img.dataobj[tuple(slicer)])
 
-    # Select the desired section of data
-    data = img.get_data()
-    data = data.reshape((nxi[0], nxi[1], nxi[2]))
+    return data.reshape(data.shape[:3])
 
-    if rc_axis == 1:
-        data = data[:, first_slice:last_slice, :]
-    else:
-        data = data[first_slice:last_slice]
+def _meshSection(data, first_slice, rc_axis = 0, step = 1):
+    """Marching cubes on a section of the volume, with vertices in voxel space"""
 
     # Create mesh using a marching cubes algorithm
     # V and F are the vertices and faces, respectively
@@ -264,24 +247,36 @@ def meshTarget(img_file, first_slice, last_slice, system = "voxel", rc_axis = 0,
     # Add the x-value of the first slice to the first coordinate of all vertices
     V[:, rc_axis] += first_slice
 
+    return V, F
+
+def _meshSlab(img_file, first_slice, last_slice, rc_axis = 0, step = 1):
+    """Load and mesh a single slab; runs in worker processes for meshTargetChunked"""
+
+    img = nib.load(img_file)
+    data = _loadSection(img, first_slice, last_slice, rc_axis)
+
+    empty = np.zeros((0, 3)), np.zeros((0, 3), dtype = np.int64)
+
+    # Slabs without any voxel above the level have no surface
+    if not (data > 0).any():
+        return empty
+
+    # Nor have slabs where the level is only crossed between the sampled slices
+    try:
+        return _meshSection(data, first_slice, rc_axis, step)
+    except RuntimeError:
+        return empty
+
+def _finishTarget(V, F, img, system = "voxel", weld = False):
+    """Coordinate conversion, face cleaning and orientation shared by the target meshing functions"""
+
     if system == "RAS":
         M = abs(img.affine[:3, :3])
         abc = img.affine[:3, 3]
         V = V.dot(M) + np.tile(abc, (V.shape[0], 1))
 
-    Vtri = V[F]
-    uniqueVidx = []  # array for storing the indices of faces with all three vertices unique
-
-    for i in range(F.shape[0]):
-        if np.unique(Vtri[i], axis = 0).shape[0] == 3:
-            uniqueVidx.append(i)
-
-    # Find indices of unique faces (two faces are considered unique if one or more of their vertices is different)
-    uniqueT, uniqueTidx = np.unique(Vtri, axis = 0, return_index = True)
-
-    # Compute intersection of the indices and keep only these faces
-    keep = np.intersect1d(uniqueVidx, uniqueTidx)
-    F = F[keep]
+    V, F, dropped = cleanFaces(V, F, weld = weld)
+    print("Removed %d degenerate and %d duplicate faces" % dropped)
 
     # Flip orientation of normal vectors so that they point outwards
     if system == "voxel":
@@ -296,6 +291,157 @@ def meshTarget(img_file, first_slice, last_slice, system = "voxel", rc_axis = 0,
 
     return tV, tF
 
+def meshTarget(img_file, first_slice, last_slice, system = "voxel", rc_axis = 0, step = 1, weld = False):
+    """Mesh binary data through marching cubes.
+
+        Args:
+            img_file (str): binary data file
+            first_slice (int): Voxel space x-coordinate of first slice (most anterior) in desired section
+            last_slice (int): Voxel space x-coordinate of last slice (most posterior) in desired section
+            system (str): specify coordinate system (voxel or RAS); default voxel
+            weld (bool): merge vertices with identical coordinates (see cleanFaces)
+
+        Returns:
+            tV (torch tensor): target mesh vertices
+            tF (torch tensor): target mesh faces
+    """
+
+    # Load the desired section of data
+    img = nib.load(img_file)
+    data = _loadSection(img, first_slice, last_slice, rc_axis)
+
+    V, F = _meshSection(data, first_slice, rc_axis, step)
+
+    return _finishTarget(V, F, img, system, weld)
+
+def meshTargetPyramid(img_file, first_slice, last_slice, system = "voxel", rc_axis = 0, steps = (1, 2), weld = False):
+    """Mesh binary data through marching cubes at several resolutions, reading the volume only once.
+
+        Args:
+            img_file (str): binary data file
+            first_slice (int): Voxel space x-coordinate of first slice (most anterior) in desired section
+            last_slice (int): Voxel space x-coordinate of last slice (most posterior) in desired section
+            system (str): specify coordinate system (voxel or RAS); default voxel
+            rc_axis (int): axis along which the slices are taken
+            steps (list): marching cubes step size of every level, finest first
+            weld (bool): merge vertices with identical coordinates (see cleanFaces)
+
+        Returns:
+            levels (list): (V, F, C, N) for every step size, i.e. the vertices, faces, centroids and normals of the mesh
+    """
+
+    img = nib.load(img_file)
+    data = _loadSection(img, first_slice, last_slice, rc_axis)
+
+    levels = []
+    for step in steps:
+        V, F = _meshSection(data, first_slice, rc_axis, step)
+        tV, tF = _finishTarget(V, F, img, system, weld)
+        C, N = compCN(tV, tF)
+        levels.append((tV, tF, C, N))
+
+    return levels
+
+def meshTargetChunked(img_file, first_slice, last_slice, system = "voxel", rc_axis = 0, step = 1, slab = 64, workers = 1):
+    """Mesh binary data through marching cubes, one slab of slices at a time.
+
+    The volume is read through the image proxy, so peak memory scales with the slab size rather than the volume.
+    Consecutive slabs share one slice, and the slab meshes are stitched by welding coincident vertices; the result
+    is the mesh of meshTarget(..., weld = True), up to the order of the faces and floating point rounding.
+
+        Args:
+            img_file (str): binary data file
+            first_slice (int): Voxel space x-coordinate of first slice (most anterior) in desired section
+            last_slice (int): Voxel space x-coordinate of last slice (most posterior) in desired section
+            system (str): specify coordinate system (voxel or RAS); default voxel
+            rc_axis (int): axis along which the slices are taken
+            step (int): marching cubes step size
+            slab (int): number of slices per slab (rounded up to a multiple of step)
+            workers (int): number of processes meshing slabs concurrently
+
+        Returns:
+            tV (torch tensor): target mesh vertices
+            tF (torch tensor): target mesh faces
+    """
+
+    slab = step * max(1, int(math.ceil(slab / step)))
+
+    # Slab boundaries; each slab includes the first slice of the next one
+    starts = list(range(first_slice, last_slice - 1, slab))
+    stops = [min(start + slab + 1, last_slice) for start in starts]
+
+    # A trailing slab thinner than step + 1 slices has no marching cubes cell left, merge it into the previous one
+    if len(starts) > 1 and stops[-1] - starts[-1] < step + 1:
+        starts.pop()
+        stops.pop()
+        stops[-1] = last_slice
+    jobs = [(img_file, start, stop, rc_axis, step) for start, stop in zip(starts, stops)]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            meshes = list(pool.map(_meshSlab, *zip(*jobs)))
+    else:
+        meshes = [_meshSlab(*job) for job in jobs]
+
+    # Stitch the slabs together
+    offsets = np.cumsum([0] + [V.shape[0] for V, F in meshes])
+    V = np.vstack([V for V, F in meshes])
+    F = np.vstack([F + offset for (V, F), offset in zip(meshes, offsets)])
+
+    # Weld the vertices shared across slab boundaries (in voxel space, where they coincide exactly)
+    V, ids = weldVertices(V)
+    F = ids[F]
+
+    return _finishTarget(V, F, nib.load(img_file), system, weld = True)
+
+def weldVertices(V):
+    """Give every vertex the index of a representative among the vertices with identical coordinates.
+
+        Args:
+            V (numpy array): mesh vertices
+
+        Returns:
+            Vwelded (numpy array): unique vertices
+            ids (numpy array): index in Vwelded of every vertex of V
+    """
+
+    Vwelded, ids = np.unique(V, axis = 0, return_inverse = True)
+
+    return Vwelded, ids.reshape(-1)
+
+def cleanFaces(V, F, weld = False):
+    """Remove degenerate faces (two or more vertices at the same position, hence zero area) and duplicate faces
+    (same vertex positions in the same order, keeping the first occurrence).
+
+        Args:
+            V (numpy array): mesh vertices
+            F (numpy array): mesh faces
+            weld (bool): if True, also merge vertices with identical coordinates and reindex the faces accordingly
+
+        Returns:
+            V (numpy array): mesh vertices (unique vertices if weld)
+            F (numpy array): remaining faces, in their original order
+            dropped (tuple): number of degenerate and number of duplicate faces removed
+    """
+
+    Vwelded, ids = weldVertices(V)
+
+    # Integer vertex keys: faces are compared through the indices of their welded vertices
+    Fid = ids[F]
+
+    degenerate = (Fid[:, 0] == Fid[:, 1]) | (Fid[:, 1] == Fid[:, 2]) | (Fid[:, 2] == Fid[:, 0])
+
+    first = np.zeros(F.shape[0], dtype = bool)
+    first[np.unique(Fid, axis = 0, return_index = True)[1]] = True
+
+    keep = first & ~degenerate
+    dropped = (int(degenerate.sum()), int((~first & ~degenerate).sum()))
+
+    if weld:
+        return Vwelded, Fid[keep], dropped
+
+    return V, F[keep], dropped
+
 def compCN(V, F):
     """Compute centroids and normals for a mesh.
 
@@ -315,6 +461,57 @@ def compCN(V, F):
 
     return C, N
 
+def compressCurrents(C, N, scale, method = "grid", iters = 10):
+    """Compress a surface seen as currents by merging nearby faces into weighted Diracs.
+
+        Faces are clustered on a grid of cell size scale (optionally refined with k-means started from the grid
+        clusters); each cluster becomes a Dirac at the |normal|-weighted mean of its centroids carrying the sum
+        of its normals. With scale small compared to the kernel sigma, kernel products against the compressed
+        currents stay close to the ones against the full mesh.
+
+        Args:
+            C (torch tensor): centroids
+            N (torch tensor): normal vectors
+            scale (float): cluster size, e.g. a fraction of the smallest sigma of the currents kernel
+            method (str): "grid" or "kmeans"
+            iters (int): k-means iterations
+
+        Returns:
+            Cc (torch tensor): centroids of the clusters
+            Nc (torch tensor): summed normals of the clusters
+
+    """
+
+    # Cluster faces on the grid
+    cells = torch.floor((C - C.min(0)[0]) / scale).to(torch.long)
+    _, ids = torch.unique(cells, dim = 0, return_inverse = True)
+
+    # Refine with k-means (Lloyd iterations) from the grid clusters
+    if method == "kmeans":
+        X = C.detach().cpu().numpy()
+        ids = ids.cpu().numpy()
+        for i in range(iters):
+            centers = np.stack([np.bincount(ids, X[:, k]) for k in range(3)], 1) / np.bincount(ids)[:, None]
+            ids_new = cKDTree(centers).query(X)[1]
+            if (ids_new == ids).all():
+                break
+            _, ids = np.unique(ids_new, return_inverse = True)
+        ids = torch.as_tensor(ids.ravel(), device = C.device)
+    elif method != "grid":
+        raise ValueError("Unknown clustering method '%s'" % method)
+
+    # Aggregate normals and |normal|-weighted centroids per cluster
+    K = int(ids.max()) + 1
+    w = N.norm(dim = 1, keepdim = True)
+    Nc = torch.zeros([K, 3], dtype = N.dtype, device = N.device).index_add_(0, ids, N)
+    Wc = torch.zeros([K, 1], dtype = N.dtype, device = N.device).index_add_(0, ids, w)
+    Cw = torch.zeros([K, 3], dtype = C.dtype, device = C.device).index_add_(0, ids, w * C)
+    Cm = torch.zeros([K, 3], dtype = C.dtype, device = C.device).index_add_(0, ids, C)
+    counts = torch.bincount(ids, minlength = K).to(C.dtype)[:, None]
+    Cc = torch.where(Wc > 0, Cw / Wc.clamp(min = 1e-30), Cm / counts)
+
+    return Cc, Nc
+
 def sumAreas(Nlist):
     """Helper function that computes the sum of the areas of all faces incident to a particular vertex.
 
@@ -348,26 +545,98 @@ def incidentFaceMap(num_points, FSj):
             index_map (dict): dictionary mapping a vertex to its incident faces (faces containing the vertex)
     """
 
-    # Initialize dictionary where each vertex maps to an empty array
-    # Indices of incident faces will be added to the array
-    index_map = dict((i, []) for i in range(num_points))
-
-    # Each face is a 3x1 array containing the indices of the vertices belonging to the face
-    # Each face has a position/index in the face array
-    # For every face, append the face's own index to the array mapped to by each vertex belonging to the face
-    for i in range(FSj.shape[0]):
-        for index in FSj[i]:
-            index_map[int(index)].append(i)
+    topology = MeshTopology(num_points, FSj)
+    index_map = dict((i, topology.faces(i).tolist()) for i in range(num_points))
 
     return index_map
 
+class MeshTopology:
+    """Array-backed vertex-face and face-vertex adjacency of a triangle mesh (CSR layout).
+
+        Args:
+            num_points (int): total number of vertices
+            FSj (array): array of faces
+
+        Attributes:
+            num_points (int): number of vertices
+            F (numpy array): face-vertex adjacency, i.e. the faces
+            offsets (numpy array): faces incident to vertex i are indices[offsets[i]:offsets[i + 1]]
+            indices (numpy array): incident face indices, grouped by vertex
+    """
+
+    def __init__(self, num_points, FSj):
+        if isinstance(FSj, torch.Tensor):
+            FSj = FSj.detach().cpu().numpy()
+
+        self.num_points = num_points
+        self.F = np.asarray(FSj, dtype = np.int64)
+
+        # Counting sort of the (vertex, face) pairs by vertex; stable, so faces stay in increasing order
+        vertex = self.F.ravel()
+        face = np.repeat(np.arange(self.F.shape[0]), self.F.shape[1])
+        counts = np.bincount(vertex, minlength = num_points)
+
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.indices = face[np.argsort(vertex, kind = 'stable')]
+
+        self._incidence = {}
+
+    def faces(self, i):
+        """Indices of the faces incident to vertex i"""
+        return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+    def incidence(self, device = 'cpu', dtype = torch.float32):
+        """Sparse vertex-face incidence matrix, built once per device and dtype"""
+
+        key = (str(device), dtype)
+        if key not in self._incidence:
+            rows = np.repeat(np.arange(self.num_points), np.diff(self.offsets))
+            idx = torch.as_tensor(np.vstack([rows, self.indices]), dtype = torch.long)
+            vals = torch.ones(idx.shape[1], dtype = dtype)
+            self._incidence[key] = torch.sparse_coo_tensor(idx, vals, (self.num_points, self.F.shape[0])).coalesce().to(device)
+
+        return self._incidence[key]
+
+def _asIncidence(index_map, N):
+    """Convert a MeshTopology, or a dictionary from incidentFaceMap, to a sparse incidence matrix matching the normals N"""
+
+    if isinstance(index_map, MeshTopology):
+        return index_map.incidence(N.device, N.dtype)
+
+    if isinstance(index_map, dict):
+        rows = [v for v in index_map for f in index_map[v]]
+        cols = [f for v in index_map for f in index_map[v]]
+        index_map = torch.sparse_coo_tensor(torch.as_tensor([rows, cols], dtype = torch.long),
+                                            torch.ones(len(rows)), (len(index_map), N.shape[0]))
+
+    return index_map.to(device = N.device, dtype = N.dtype)
+
+def vertexNormals(N, index_map):
+    """Compute the normal at every vertex as the sum of the incident face normals divided by the sum of their areas.
+
+        Args:
+            N (torch tensor): face normals (unnormalized, i.e. magnitude = area of face)
+            index_map (MeshTopology): mesh topology (a sparse incidence matrix or a dictionary from incidentFaceMap is also accepted)
+
+        Returns:
+            nN (torch tensor): vertex normals
+    """
+
+    incidence = _asIncidence(index_map, N)
+
+    # The summed areas are treated as constants, as in sumAreas
+    areas = (N ** 2).sum(dim = 1, keepdim = True).sqrt().detach()
+    nN = torch.sparse.mm(incidence, N) / torch.sparse.mm(incidence, areas)
+
+    return nN
+
 # rename to verticesUL_wconst
 def surfaceULfast(VSj, index_map, N, w):
     """Compute vertices for the upper and lower surfaces, each at distance w from the midsurface
 
         Args:
             VSj (torch tensor): Duplicated midsurface vertices
-            index_map (dict): dictionary mapping vertices to incident faces
+            index_map (MeshTopology): mesh topology
             N (torch tensor): normals
             w (float): distance from midsurface to the upper/lower surface. Constant scalar.
 
@@ -375,10 +644,10 @@ def surfaceULfast(VSj, index_map, N, w):
             VSj (torch tensor): vertices of upper and lower surface
     """
 
-    for i in range(int(VSj.shape[0]/2)):
-        nN = N[index_map[i]].sum(dim=0) / sumAreas(N[index_map[i]])
-        VSj[i + int(VSj.shape[0]/2)] = VSj[i + int(VSj.shape[0]/2)] - w*nN
-        VSj[i] = VSj[i] + w * nN
+    half = int(VSj.shape[0]/2)
+    nN = vertexNormals(N, index_map)[:half]
+
+    VSj = torch.cat((VSj[:half] + w*nN, VSj[half:] - w*nN), 0)
 
     return VSj
 
@@ -389,17 +658,18 @@ def surfaceULW(VSj, W, index_map, N):
         Args:
             VSj (torch tensor): Duplicated midsurface vertices
             W (torch tensor): distance from midsurface to the upper/lower surface. Scalar field.
-            index_map (dict): dictionary mapping vertices to incident faces
+            index_map (MeshTopology): mesh topology
             N (torch tensor): normals
 
         Returns:
             VSj (torch tensor): vertices of upper and lower surface
     """
 
-    for i in range(int(VSj.shape[0]/2)):
-        nN = N[index_map[i]].sum(dim=0) / sumAreas(N[index_map[i]])
-        VSj[i + int(VSj.shape[0]/2)] = VSj[i] - W[i]*nN
-        VSj[i] = VSj[i] + W[i] * nN
+    half = int(VSj.shape[0]/2)
+    nN = vertexNormals(N, index_map)[:half]
+    W = W.reshape(-1, 1)
+
+    VSj = torch.cat((VSj[:half] + W*nN, VSj[:half] - W*nN), 0)
 
     return VSj
 
@@ -411,17 +681,19 @@ def surfaceULnonsymm(VSj, Wu, Wl, index_map, N):
             VSj (torch tensor): Duplicated midsurface vertices
             Wu (torch tensor): distance from midsurface to the upper surface. Scalar field.
             Wl (torch tensor): distance from midsurface to lower surface. Scalar field.
-            index_map (dict): dictionary mapping vertices to incident faces
+            index_map (MeshTopology): mesh topology
             N (torch tensor): normals
 
         Returns:
             VSj (torch tensor): vertices of upper and lower surface
     """
 
-    for i in range(int(VSj.shape[0] / 2)):
-        nN = N[index_map[i]].sum(dim=0) / sumAreas(N[index_map[i]])
-        VSj[i + int(VSj.shape[0] / 2)] = VSj[i] - Wl[i] * nN
-        VSj[i] = VSj[i] + Wu[i] * nN
+    half = int(VSj.shape[0] / 2)
+    nN = vertexNormals(N, index_map)[:half]
+    Wu = Wu.reshape(-1, 1)
+    Wl = Wl.reshape(-1, 1)
+
+    VSj = torch.cat((VSj[:half] + Wu * nN, VSj[:half] - Wl * nN), 0)
 
     return VSj
 
@@ -505,6 +777,31 @@ def joinFlip(F, m, n):
     
     return tFjoined
 
+# Topologies of joined surfaces, keyed on the midsurface grid
+_joinedTopologies = {}
+
+def joinedTopology(F, m, n):
+    """Compute faces and topology for joined upper and lower surfaces, cached per (m, n) grid topology.
+
+        Args:
+            F (torch tensor): faces of midsurface
+            m (int): number of vertices along u-axis of midsurface grid
+            n (int): number of vertices along v-axis of midsurface grid
+
+        Returns:
+            tFjoined (torch tensor): all faces for the joined surfaces
+            topology (MeshTopology): topology of the joined surfaces
+    """
+
+    Fnp = np.ascontiguousarray(torch.as_tensor(F).detach().cpu().numpy(), dtype = np.int64)
+    key = (m, n, hashlib.sha1(Fnp.tobytes()).hexdigest())
+
+    if key not in _joinedTopologies:
+        tFjoined = joinFlip(torch.as_tensor(Fnp), m, n)
+        _joinedTopologies[key] = (tFjoined, MeshTopology(2 * m * n, tFjoined))
+
+    return _joinedTopologies[key]
+
 def generateSourceULfast(Qd, w, Fjpre, map):
     """Function called by user to generate upper and lower surfaces with constant w.
 
@@ -512,7 +809,7 @@ def generateSourceULfast(Qd, w, Fjpre, map):
             Qd (torch tensor): duplicated midsurface vertices
             w (float): distance from midsurface to the upper/lower surface. Constant scalar.
             Fjpre (torch tensor): faces of joined upper and lower surfaces
-            map (dict): maps each vertex to incident faces
+            map (MeshTopology): topology of the joined surfaces
 
         Returns:
             Vul: vertices of upper and lower surfaces
@@ -530,7 +827,7 @@ def generateSourceULW(Qd, W, Fjpre, map):
            Qd (torch tensor): duplicated midsurface vertices
            w (torch tensor): distance from midsurface to the upper/lower surface. Scalar field.
            Fjpre (torch tensor): faces of joined upper and lower surfaces
-           map (dict): maps each vertex to incident faces
+           map (MeshTopology): topology of the joined surfaces
 
        Returns:
            Vul: vertices of upper and lower surfaces
@@ -549,7 +846,7 @@ def generateSourceULnonsymm(Vj, Wu, Wl, FSj, fmap):
            Wu (torch tensor): distance from midsurface to the upper surface. Scalar field.
            Wl (torch tensor): distance from midsurface to the lower surface. Scalar field.
            Fjpre (torch tensor): faces of joined upper and lower surfaces
-           map (dict): maps each vertex to incident faces
+           map (MeshTopology): topology of the joined surfaces
 
        Returns:
            Vul: vertices of upper and lower surfaces
@@ -607,71 +904,167 @@ def flatten(mesh, m, n):
 
     return dugrid.flatten(), dvgrid.flatten()
 
-def kNN(Q, cd, nn = 5):
+# Column of every subfield in the label weights computed by kNN
+label_dict = {'presubiculum': 0, 'subiculum': 1, 'parasubiculum':2, 'ca1': 3, 'ca2': 4, 'ca3': 5}
+
+class LabelIndex:
+    """KD-tree over a labeled point cloud, built once and shared by all kNN queries against that cloud.
+
+        Args:
+            cd (pandas): point cloud dataframe with coordinate columns 0, 1, 2 and a 'label' column
+
+        Attributes:
+            tree (cKDTree): spatial index over the points
+            codes (numpy array): label_dict code of every point
+    """
+
+    def __init__(self, cd):
+        self.tree = cKDTree(np.asarray(cd[[0, 1, 2]].values, dtype = np.float64))
+        self.codes = np.asarray(pd.Categorical(cd['label'], categories = list(label_dict)).codes, dtype = np.int64)
+
+    def query(self, Q, nn = 5):
+        """Label counts among the nn nearest points of every query point"""
+
+        if isinstance(Q, torch.Tensor):
+            Q = Q.detach().cpu().numpy()
+
+        d, idx = self.tree.query(np.asarray(Q, dtype = np.float64), k = nn)
+        idx = idx.reshape(-1, nn)
 
-    label_dict = {'presubiculum': 0, 'subiculum': 1, 'parasubiculum':2, 'ca1': 3, 'ca2': 4, 'ca3': 5}
-    labels = np.zeros((Q.shape[0], len(label_dict)))
+        # Histogram of the neighbour labels: one column per subfield
+        labels = (self.codes[idx][:, :, None] == np.arange(len(label_dict))).sum(axis = 1).astype(np.float64)
 
-    for c, pt in enumerate(Q):
-        d_idx = np.argsort(np.linalg.norm(cd[[0, 1, 2]] - pt, axis=1))
-        dn_idx = d_idx[0:nn]
-        l = cd.iloc[dn_idx]['label']
+        return labels
 
-        for k in label_dict.keys():
-            nk = np.sum(l == k)
-            labels[c][label_dict[k]] += nk
+def kNN(Q, cd, nn = 5):
+    """Label points by majority among their nearest neighbours in the labeled point cloud.
 
-        if c % 500 == 0:
-            print(c)
+        Args:
+            Q (torch tensor): points to label, e.g. midsurface vertices
+            cd (pandas or LabelIndex): labeled point cloud, or an index already built over it
+            nn (int): number of neighbours
+
+        Returns:
+            labels (numpy array): number of neighbours of every point in each subfield (columns ordered as label_dict)
+            label_weights (numpy array): labels / nn
+    """
+
+    index = cd if isinstance(cd, LabelIndex) else LabelIndex(cd)
+    labels = index.query(Q, nn)
 
     label_weights = labels/(nn)
 
     return labels, label_weights
 
 
-def surfaceIsocontour(V, F, lw, reg, t=0.6):
-    b = np.zeros((3 * F.shape[0], 3))
-    c = 0
-
-    for f in F:
-        v1, v2, v3 = V[f[0]], V[f[1]], V[f[2]]
-        l1, l2, l3 = lw[f[0]][reg], lw[f[1]][reg], lw[f[2]][reg]
-        a = [l1 > t, l2 > t, l3 > t]
-
-        if a == [1, 0, 0] or a == [0, 1, 1]:
-            d = abs(l1 - t) / abs(l1 - l2)
-            b1 = v1 * (1 - d) + v2 * d
-            d = abs(l1 - t) / abs(l1 - l3)
-            b2 = v1 * (1 - d) + v3 * d
-            b[c] = b1
-            b[c + 1] = b2
-            b[c + 2] = None
-            c += 3
-
-        elif a == [0, 1, 0] or a == [1, 0, 1]:
-            d = abs(l2 - t) / abs(l2 - l1)
-            b1 = v2 * (1 - d) + v1 * d
-            d = abs(l2 - t) / abs(l2 - l3)
-            b2 = v2 * (1 - d) + v3 * d
-            b[c] = b1
-            b[c + 1] = b2
-            b[c + 2] = None
-            c += 3
-
-        elif a == [0, 0, 1] or a == [1, 1, 0]:
-            d = abs(l3 - t) / abs(l3 - l1)
-            b1 = v3 * (1 - d) + v1 * d
-            d = abs(l3 - t) / abs(l3 - l2)
-            b2 = v3 * (1 - d) + v2 * d
-            b[c] = b1
-            b[c + 1] = b2
-            b[c + 2] = None
-            c += 3
-
-        else:
+def _chainSegments(segments):
+    """Join segments sharing an endpoint into polylines.
+
+        Args:
+            segments (numpy array): (S, 2) endpoint ids of every segment; an endpoint belongs to at most two segments
+
+        Returns:
+            chains (list): endpoint ids along every polyline; closed polylines repeat their first endpoint at the end
+    """
+
+    incident = {}
+    for s, (a, b) in enumerate(segments.tolist()):
+        incident.setdefault(a, []).append(s)
+        incident.setdefault(b, []).append(s)
+
+    used = np.zeros(segments.shape[0], dtype = bool)
+    chains = []
+
+    # Open polylines start at an endpoint of a single segment; whatever remains afterwards is closed
+    starts = [a for a in incident if len(incident[a]) == 1] + segments[:, 0].tolist()
+
+    for start in starts:
+        if all(used[s] for s in incident[start]):
             continue
 
-    return b[0:c, :]
+        chain = [start]
+        node = start
+        while True:
+            free = [s for s in incident[node] if not used[s]]
+            if not free:
+                break
+            used[free[0]] = True
+            a, b = segments[free[0]]
+            node = b if a == node else a
+            chain.append(node)
+
+        chains.append(chain)
+
+    return chains
+
+def surfaceIsocontours(V, F, lw, regs = None, t = 0.6):
+    """Extract isocontours of label weights on a surface (marching triangles), for several regions and thresholds at once.
+
+        Args:
+            V (torch tensor): mesh vertices
+            F (torch tensor): mesh faces
+            lw (numpy array): label weights of every vertex, one column per region (see kNN)
+            regs (list): columns of lw to extract; default all
+            t (float or list): threshold(s) defining the contours
+
+        Returns:
+            contours (dict): for every (region, threshold), a list of polylines ((k, 3) numpy arrays)
+    """
+
+    if isinstance(V, torch.Tensor):
+        V = V.detach().cpu().numpy()
+    if isinstance(F, torch.Tensor):
+        F = F.detach().cpu().numpy()
+    lw = np.asarray(lw)
+    regs = list(range(lw.shape[1])) if regs is None else list(regs)
+    ts = np.atleast_1d(np.asarray(t, dtype = float))
+
+    # One channel per (region, threshold), region major: channel c is region c // T at threshold ts[c % T]
+    L = lw[:, regs]
+    above = (L[..., None] > ts).reshape(L.shape[0], -1)
+
+    # Edges (f0, f1), (f1, f2), (f2, f0) of every face, and whether the contour of each channel crosses them
+    Ea, Eb = F[:, [0, 1, 2]], F[:, [1, 2, 0]]
+    crossing = above[Ea] != above[Eb]
+
+    # A face crossed by the contour of a channel has exactly two crossing edges: each gives one segment
+    face, chan = np.nonzero(crossing.any(axis = 1))
+    slot = np.nonzero(crossing[face, :, chan])[1].reshape(-1, 2)
+
+    lo = np.minimum(Ea[face[:, None], slot], Eb[face[:, None], slot])
+    hi = np.maximum(Ea[face[:, None], slot], Eb[face[:, None], slot])
+
+    # Linear interpolation of the crossing point along every edge
+    reg, level = (chan // ts.size)[:, None], ts[chan % ts.size][:, None]
+    l_lo, l_hi = L[lo, reg], L[hi, reg]
+    d = (abs(l_lo - level) / abs(l_lo - l_hi))[..., None]
+    points = V[lo] * (1 - d) + V[hi] * d
+
+    # Crossing points are identified by their edge, so that neighbouring segments connect
+    keys = lo * V.shape[0] + hi
+
+    contours = {}
+    for r, region in enumerate(regs):
+        for k, threshold in enumerate(ts.tolist()):
+            sel = chan == r * ts.size + k
+            edges, first, nodes = np.unique(keys[sel], return_index = True, return_inverse = True)
+            node_points = points[sel].reshape(-1, 3)[first]
+
+            contours[(region, threshold)] = [node_points[chain] for chain in _chainSegments(nodes.reshape(-1, 2))]
+
+    return contours
+
+def joinPolylines(polylines):
+    """Concatenate polylines into a single array, each followed by a row of NaNs (for plotting)"""
+
+    rows = [np.vstack([p, np.full((1, 3), np.nan)]) for p in polylines]
+
+    return np.vstack(rows) if rows else np.zeros((0, 3))
+
+def surfaceIsocontour(V, F, lw, reg, t=0.6):
+    """Isocontour of the label weights of a single region, as NaN-separated polylines (see surfaceIsocontours)"""
+
+    return joinPolylines(surfaceIsocontours(V, F, lw, [reg], t)[(reg, float(t))])
 
 def plot_mesh(V, F, color):
 
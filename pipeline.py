@@ -1,6 +1,8 @@
-from PointCloud import PointCloud
+import os
+from PointCloud import PointCloud, saveColumnar
 from Midsurface import Midsurface
 import mesh
+import artifacts
 import Optimization
 import torch
 import pickle
@@ -9,6 +11,8 @@ import argparse as ap
 
 """Example pipeline from reading of data to completion of optimization """
 
+STAGES = ["pointcloud", "midsurface", "target", "optimizeQ", "optimizeW", "unfoldQ", "unfold", "map"]
+
 def get_args():
     p = ap.ArgumentParser()
 
@@ -17,114 +21,167 @@ def get_args():
     p.add_argument("--last_slice", type = int, required = True)
     p.add_argument("--cached_surface", type = int, required = True, choices = [0, 1])
     p.add_argument("--rc_axis", type = int, required = True, choices = [0,1])
+    p.add_argument("--rerun", type = str, nargs = "*", default = [], choices = STAGES, help = "stages to run even if their inputs did not change")
 
     return p.parse_args()
 
 
+def outdir(args):
+    """Output directory of a brain"""
+    return 'hippocampus/thicknessMap/dataframes/brain' + args.brain
+
+
+def figure(args, fig, name):
+    """Write a figure to the output directory of the brain, opened in the browser unless args.show is False"""
+    plot(fig, filename = os.path.join(outdir(args), name + '.html'), auto_open = getattr(args, 'show', True))
+
+
+def pointcloud(path, first_slice, last_slice, rc_axis, columnar):
+    """Stage: read the binary segmentations of a brain as a point cloud, also saved in columnar form"""
+    pc = PointCloud(path, combined = False, rc_axis = rc_axis, max_workers = 6)
+    pc.Cartesian(first_slice, last_slice, system = "RAS")
+    saveColumnar(columnar, pc.cartesian_data, pc.cartesian_data_ras)
+
+    return pc
+
+
+def midsurface(pc):
+    """Stage: initial midsurface of a point cloud"""
+    ms = Midsurface(pc, system = "RAS")
+    ms.curves(4)
+
+    return ms.surface(100, 100)
+
+
+def readSource(path):
+    """Stage: midsurface saved by an earlier run"""
+    with open(path, 'rb') as input:
+        return pickle.load(input)
+
+
+def optimization(source, target, m = 50, n = 50):
+    """Optimization of a source midsurface against the full resolution target mesh"""
+    (VH, FH, CH, NH), (VHds, FHds, CHds, NHds) = target
+
+    return Optimization.Optimization(source, VH, FH, m, n)
+
+
+def sigmas(opt, values):
+    return [torch.tensor([s], dtype = opt.torchdtype, device = opt.torchdeviceId) for s in values]
+
+
+def optimizeQ(source, target, m, n, w, sigmacurrs, sigmadiffs, sigmaw, gamma, beta):
+    """Stage: optimize the midsurface, returns Qopt and Wopt"""
+    opt = optimization(source, target, m, n)
+    opt.optimizeQ(w * torch.ones(m*n, 1), sigmas(opt, sigmacurrs), sigmas(opt, sigmadiffs), sigmas(opt, [sigmaw])[0], gamma, beta)
+
+    return opt.Qopt.detach().cpu(), opt.Wopt.detach().cpu()
+
+
+def optimizeW(source, target, qw, m, n, sigmacurrs, sigmaws, gamma, beta):
+    """Stage: optimize the upper and lower widths of the midsurface qw = (Qopt, Wopt), returns Wuopt and Wlopt"""
+    opt = optimization(source, target, m, n)
+    opt.Qopt, W = qw
+    opt.optimizeW(W, W, sigmas(opt, sigmacurrs), sigmas(opt, sigmaws), gamma, beta)
+
+    return opt.Wuopt.detach().cpu(), opt.Wlopt.detach().cpu()
+
+
+def unfold(source, target, qw, wulw = None):
+    """Stage: unfolded surfaces and thickness map, after Q optimization or after W optimization if wulw is given"""
+    opt = optimization(source, target)
+    Q, W = qw
+    wu, wl = (W, W) if wulw is None else (abs(wulw[0]), abs(wulw[1]))
+
+    return opt.unfold(Q, wu.flatten(), wl.flatten())
+
+
+def thicknessMap(source, target, qw, wulw):
+    """Stage: vertices of the optimized upper and lower surfaces, and the faces of the source"""
+    opt = optimization(source, target)
+    Qd = mesh.doubleQ(qw[0])
+
+    Fjoined, facemap = mesh.joinedTopology(opt.FS, 50, 50)
+    VS = mesh.generateSourceULnonsymm(Qd, abs(wulw[0].flatten()), abs(wulw[1].flatten()), Fjoined, facemap)
+
+    return VS.detach(), opt.FS
+
 
 def build(args):
-    if args.cached_surface == 0:
-        # Read binary data
-        pc = PointCloud('/cis/project/exvivohuman_11T/data/subfield_masks/brain_' + args.brain + '/eileen_brain' + args.brain + '_segmentations/', combined = False, rc_axis = args.rc_axis)
-        pc.Cartesian(args.first_slice, args.last_slice, system = "RAS")
+    os.makedirs(outdir(args), exist_ok = True)
 
-        with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/cartesian_pc_ras_brain' + args.brain, 'wb') as output:
-            pickle.dump(pc_uc.cartesian_data_ras, output)
+    # Stages are only run when their inputs changed since the last run, their results are kept in outdir/stages
+    store = artifacts.Store(outdir(args) + '/stages', rerun = getattr(args, 'rerun', None) or [])
 
-        # Create midsurface
-        ms = Midsurface(pc, system = "RAS")
-        ms.curves(4)
-        source = ms.surface(100, 100)
+    if args.cached_surface == 0:
+        # Read binary data and create midsurface
+        path = '/cis/project/exvivohuman_11T/data/subfield_masks/brain_' + args.brain + '/eileen_brain' + args.brain + '_segmentations/'
+        pc = store.stage('pointcloud', pointcloud, files = [path + img + '.img' for img in PointCloud.img_files], path = path,
+                         first_slice = args.first_slice, last_slice = args.last_slice, rc_axis = args.rc_axis,
+                         columnar = outdir(args) + '/cartesian_pc_ras_brain' + args.brain)
+        source = store.stage('midsurface', midsurface, pc)
 
     else:
-        with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/sourcePC', 'rb') as input:
-            source = pickle.load(input)
+        path = outdir(args) + '/sourcePC'
+        source = store.stage('midsurface', readSource, files = [path], path = path)
 
-    # Create target mesh
-    VH, FH = mesh.meshTarget('hippocampus/BrainData/brain' + args.brain + '/caSubBrain' + args.brain + '.img', args.first_slice, args.last_slice, system = "RAS", rc_axis = args.rc_axis)
-    VHds, FHds = mesh.meshTarget('hippocampus/BrainData/brain' + args.brain + '/caSubBrain' + args.brain + '.img', args.first_slice, args.last_slice, system = "RAS", rc_axis = args.rc_axis, step = 2)
+    # Create target mesh, at full resolution and downsampled for visualization
+    img = 'hippocampus/BrainData/brain' + args.brain + '/caSubBrain' + args.brain + '.img'
+    target = store.stage('target', mesh.meshTargetPyramid, files = [img], img_file = img, first_slice = args.first_slice,
+                         last_slice = args.last_slice, system = "RAS", rc_axis = args.rc_axis, steps = (1, 2))
 
     # Optimize midsurface
     m = 50
     n = 50
-    opt = Optimization.Optimization(source, VH, FH)
-    w = 0.48 * torch.ones(m*n, 1)
-    sigmacurrs = [torch.tensor([.96], dtype=opt.torchdtype, device=opt.torchdeviceId),
-                  torch.tensor([0.48], dtype=opt.torchdtype, device=opt.torchdeviceId)]
-    sigmadiffs = [torch.tensor([2.4], dtype=opt.torchdtype, device=opt.torchdeviceId),
-                  torch.tensor([1.2], dtype=opt.torchdtype, device=opt.torchdeviceId)]
-    sigmaw = torch.tensor([3.6], dtype=opt.torchdtype, device=opt.torchdeviceId)
-    gamma = 0.12
-    beta = 6
-
-    #qreslist, wreslist = opt.optimizeQ(w, sigmacurrs, sigmadiffs, sigmaw, gamma, beta)
-    opt.optimizeQ(w, sigmacurrs, sigmadiffs, sigmaw, gamma, beta)
+    qopt = store.stage('optimizeQ', optimizeQ, source, target, m = m, n = n, w = 0.48, sigmacurrs = [.96, 0.48],
+                       sigmadiffs = [2.4, 1.2], sigmaw = 3.6, gamma = 0.12, beta = 6)
+
+    # Optimize W scalar field
+    wopt = store.stage('optimizeW', optimizeW, source, target, qopt, m = m, n = n, sigmacurrs = [1, 0.6],
+                       sigmaws = [3, 1, 0.3], gamma = 1, beta = 1)
+
+    # Unfolded surface and thickness map after midsurface optimization, and after W optimization
+    unfoldQ = store.stage('unfoldQ', unfold, source, target, qopt)
+    unfoldW = store.stage('unfold', unfold, source, target, qopt, wopt)
+    surfaces = store.stage('map', thicknessMap, source, target, qopt, wopt)
 
     # Visualize midsurface optimization results
+    opt = optimization(source.value, target.value, m, n)
+    opt.Qopt, opt.Wopt = qopt.value
+    (VH, FH, CH, NH), (VHds, FHds, CHds, NHds) = target.value
+
     figMS = opt.visualizeMidsurface(opt.Qopt)
     figJoined = opt.visualizeJoinedsurface(opt.Qopt, opt.Wopt.flatten())
     figSourceTarget = opt.visualizeSourceTarget(opt.Qopt, opt.Wopt.flatten(), VHds, FHds)
 
-    plot(figMS)
-    plot(figJoined)
-    plot(figSourceTarget)
+    figure(args, figMS, 'midsurface')
+    figure(args, figJoined, 'joined')
+    figure(args, figSourceTarget, 'sourceTarget')
 
-    # Visualize unfolded surface and thickness map after midsurface optimization
-    #uvw_upper, uvw_lower, uvw_thickness = opt.unfold(qreslist[-1].detach().cpu(), wreslist[-1].flatten().detach().cpu(), wreslist[-1].flatten().detach().cpu())
-    uvw_upper, uvw_lower, uvw_thickness = opt.unfold(opt.Qopt.detach().cpu(), opt.Wopt.flatten().detach().cpu(), opt.Wopt.flatten().detach().cpu())
+    uvw_upper, uvw_lower, uvw_thickness = unfoldQ.value
     figW, figThickness = opt.visualizeUnfolded(uvw_upper, uvw_lower, uvw_thickness)
 
-    plot(figW)
-    plot(figThickness)
+    figure(args, figW, 'unfolded')
+    figure(args, figThickness, 'thickness')
 
-    # Optimize W scalar field
-    #wu = wreslist[-1].clone()
-    #wl = wreslist[-1].clone()
-    sigmacurrs = [torch.tensor([1], dtype = opt.torchdtype, device = opt.torchdeviceId),
-                  torch.tensor([0.6], dtype = opt.torchdtype, device = opt.torchdeviceId)]
-    sigmaws = [torch.tensor([3], dtype = opt.torchdtype, device = opt.torchdeviceId),
-               torch.tensor([1], dtype = opt.torchdtype, device = opt.torchdeviceId),
-              torch.tensor([0.3], dtype = opt.torchdtype, device = opt.torchdeviceId)]
-    gamma = 1
-    beta = 1
-
-    # Visualize W optimization results
-    #wureslist, wlreslist = opt.optimizeW(wu, wl, sigmacurrs, sigmaws, gamma, beta)
-    opt.optimizeW(opt.Wopt, opt.Wopt, sigmacurrs, sigmaws, gamma, beta)
-    #figJoinedNonsymm = opt.visualizeJoinedsurfaceNonsymm(qreslist[-1], wureslist[-1].flatten(), wlreslist[-1].flatten())
-    #figSourceTargetNonsymm = opt.visualizeSourceTargetNonsymm(qreslist[-1], wureslist[-1].flatten(), wlreslist[-1].flatten(),VHds, FHds)
-
-    # Visualize unfolded surface and thickness map after W optimization
-    #uvw_upper, uvw_lower, uvw_thickness = opt.unfold(qreslist[-1].detach().cpu(), abs(wureslist[-1].flatten().detach().cpu()), abs(wlreslist[-1].flatten().detach().cpu()))
-    uvw_upper, uvw_lower, uvw_thickness = opt.unfold(opt.Qopt.detach().cpu(), abs(opt.Wuopt.flatten().detach().cpu()),
-                                                     abs(opt.Wlopt.flatten().detach().cpu()))
-    #figW, figThickness = opt.visualizeUnfolded(uvw_upper, uvw_lower, uvw_thickness)
-
-    #Q = qreslist[-1].detach().cpu()
-    Qd = mesh.doubleQ(opt.Qopt.detach().cpu())
-
-    Fjoined = mesh.joinFlip(opt.FS, 50, 50)
-    facemap = mesh.incidentFaceMap(2 * 50 * 50, Fjoined)
-    VS = mesh.generateSourceULnonsymm(Qd, abs(opt.Wuopt.detach().flatten()), abs(opt.Wlopt.detach().flatten()),
-                                      Fjoined, facemap)
-
-    with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/sourceUpper_optimized_brain' + args.brain, 'wb') as output:
-        pickle.dump(VS[0:2500].detach(), output)
-
-    with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/sourceLower_optimized_brain' + args.brain, 'wb') as output:
+    # Save results after W optimization
+    uvw_upper, uvw_lower, uvw_thickness = unfoldW.value
+    VS, FS = surfaces.value
+
+    with open(outdir(args) + '/sourceUpper_optimized_brain' + args.brain, 'wb') as output:
+        pickle.dump(VS[0:2500], output)
+
+    with open(outdir(args) + '/sourceLower_optimized_brain' + args.brain, 'wb') as output:
         pickle.dump(VS[2500:], output)
 
-    with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/sourceFaces_brain' + args.brain, 'wb') as output:
-        pickle.dump(opt.FS, output)
+    with open(outdir(args) + '/sourceFaces_brain' + args.brain, 'wb') as output:
+        pickle.dump(FS, output)
 
-    with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/uvw_thickness_brain' + args.brain, 'wb') as output:
+    with open(outdir(args) + '/uvw_thickness_brain' + args.brain, 'wb') as output:
         pickle.dump(uvw_thickness, output)
 
-    with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/sourceQ_optimized_brain' + args.brain, 'wb') as output:
-        pickle.dump(opt.Qopt.detach().cpu(), output)
-
-    with open('hippocampus/thicknessMap/dataframes/brain' + args.brain + '/opt_brain' + args.brain, 'wb') as output:
-        pickle.dump(opt, output)
+    with open(outdir(args) + '/sourceQ_optimized_brain' + args.brain, 'wb') as output:
+        pickle.dump(opt.Qopt, output)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+import os
+import csv
+import json
+import time
+import traceback
+import contextlib
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from argparse import Namespace
+import argparse as ap
+
+"""Run pipeline.build for several brains, listed in a manifest, on a pool of worker processes.
+
+    The manifest is a csv file with one job per row and the columns brain, first_slice, last_slice, rc_axis and
+    cached_surface (the arguments of pipeline.py). Each job runs in its own process, pinned to a slot: a device
+    (a GPU, or the CPU) and a set of CPU cores, with an optional memory limit for CPU jobs. The log and the
+    status of each job are written to the output directory of its brain (see pipeline.outdir), next to its
+    results; jobs already done with the same arguments are skipped when the runner is started again, and failed
+    ones are retried.
+
+    Example:
+        python pipelineBatch.py --manifest brains.csv --devices cuda:0,cuda:1 --threads 4
+"""
+
+COLUMNS = ["brain", "first_slice", "last_slice", "rc_axis", "cached_surface"]
+
+
+def get_args():
+    p = ap.ArgumentParser()
+
+    p.add_argument("--manifest", type = str, required = True)
+    p.add_argument("--devices", type = str, default = None, help = "comma separated devices, e.g. cuda:0,cuda:1 or cpu; all GPUs, or the CPU, by default")
+    p.add_argument("--jobs_per_device", type = int, default = 1)
+    p.add_argument("--threads", type = int, default = None, help = "CPU cores per job, the cores are shared between the slots by default")
+    p.add_argument("--memory", type = float, default = None, help = "limit on the data segment (heap and anonymous mappings) of CPU jobs, in GB")
+    p.add_argument("--retries", type = int, default = 1)
+    p.add_argument("--force", action = "store_true", help = "rerun jobs already done")
+
+    return p.parse_args()
+
+
+def readManifest(path):
+    """Jobs of a manifest, as dicts of the pipeline arguments"""
+    with open(path, newline = '') as input:
+        rows = list(csv.DictReader(input))
+
+    jobs = []
+    for row in rows:
+        missing = [c for c in COLUMNS if not row.get(c)]
+        if missing:
+            raise ValueError("Manifest row %s: missing %s" % (row, ", ".join(missing)))
+        jobs.append({"brain": row["brain"].strip(), "first_slice": int(row["first_slice"]), "last_slice": int(row["last_slice"]),
+                     "rc_axis": int(row["rc_axis"]), "cached_surface": int(row["cached_surface"])})
+
+    brains = [job["brain"] for job in jobs]
+    if len(set(brains)) != len(brains):
+        raise ValueError("Manifest lists a brain more than once, results are written per brain")
+
+    return jobs
+
+
+def slots(devices, jobs_per_device, threads):
+    """Worker slots, (device, CPU cores), jobs_per_device for each device and disjoint cores when there are enough"""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    devices = devices * jobs_per_device
+    threads = threads or max(1, len(cpus) // len(devices))
+
+    return [(device, [cpus[(k * threads + i) % len(cpus)] for i in range(threads)]) for k, device in enumerate(devices)]
+
+
+def defaultDevices():
+    import torch
+
+    return ["cuda:%d" % k for k in range(torch.cuda.device_count())] or ["cpu"]
+
+
+def statusPath(job):
+    from pipeline import outdir
+
+    return os.path.join(outdir(Namespace(**job)), "status.json")
+
+
+def readStatus(job):
+    try:
+        with open(statusPath(job)) as input:
+            return json.load(input)
+    except (OSError, ValueError):
+        return None
+
+
+def writeStatus(job, status):
+    os.makedirs(os.path.dirname(statusPath(job)), exist_ok = True)
+    with open(statusPath(job), "w") as output:
+        json.dump(status, output, indent = 1)
+
+
+def pin(slot, memory):
+    """Pin the current process to a slot, before torch is imported"""
+    device, cpus = slot
+    os.environ["CUDA_VISIBLE_DEVICES"] = (device.split(":") + ["0"])[1] if device.startswith("cuda") else ""
+    os.environ["OMP_NUM_THREADS"] = str(len(cpus))
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+    # RLIMIT_DATA counts the heap and anonymous mappings but not the shared libraries, which alone map gigabytes
+    # with torch; CUDA reserves far more than it uses, the limit only applies to CPU jobs
+    if memory and not device.startswith("cuda"):
+        import resource
+        limit = int(memory * 2 ** 30)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def runJob(job, slot, memory, path):
+    """Worker process: run pipeline.build for one brain, with its output in the brain's log at path"""
+    pin(slot, memory)
+
+    with open(path, "a") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print("=== brain %s on %s, cores %s, %s" % (job["brain"], slot[0], slot[1], time.ctime()), flush = True)
+        try:
+            import pipeline
+            pipeline.build(Namespace(show = False, **job))
+        except Exception:
+            traceback.print_exc()
+            failed = True
+        else:
+            failed = False
+
+    if failed:
+        raise SystemExit(1)
+
+
+def run(jobs, slots, memory = None, retries = 1, force = False):
+    """Run the jobs on the slots, one process per job. Returns the final status of each brain"""
+    todo = []
+    for job in jobs:
+        status = readStatus(job)
+        if not force and status is not None and status["state"] == "done" and status["job"] == job:
+            print("brain %s: done, skipped" % job["brain"])
+        else:
+            todo.append((job, 0))
+
+    ctx = mp.get_context("spawn")
+    free = list(slots)
+    running = {}
+    final = {}
+
+    while todo or running:
+        while todo and free:
+            (job, attempt), slot = todo.pop(0), free.pop(0)
+            os.makedirs(os.path.dirname(statusPath(job)), exist_ok = True)
+            path = os.path.join(os.path.dirname(statusPath(job)), "log.txt")
+            p = ctx.Process(target = runJob, args = (job, slot, memory, path))
+            p.start()
+            running[p.sentinel] = (p, job, slot, attempt, time.time())
+            print("brain %s: started on %s (attempt %d)" % (job["brain"], slot[0], attempt + 1))
+
+        for sentinel in wait(list(running)):
+            p, job, slot, attempt, start = running.pop(sentinel)
+            p.join()
+            free.append(slot)
+
+            state = "done" if p.exitcode == 0 else "failed"
+            status = {"job": job, "state": state, "exitcode": p.exitcode, "attempts": attempt + 1,
+                      "device": slot[0], "seconds": round(time.time() - start, 1), "finished": time.ctime()}
+            writeStatus(job, status)
+            print("brain %s: %s in %.0f s" % (job["brain"], state, status["seconds"]))
+
+            if state == "failed" and attempt < retries:
+                todo.append((job, attempt + 1))
+            else:
+                final[job["brain"]] = status
+
+    return final
+
+
+if __name__ == "__main__":
+    args = get_args()
+    jobs = readManifest(args.manifest)
+    devices = args.devices.split(",") if args.devices else defaultDevices()
+    final = run(jobs, slots(devices, args.jobs_per_device, args.threads), args.memory, args.retries, args.force)
+
+    failed = [brain for brain, status in final.items() if status["state"] != "done"]
+    if failed:
+        print("failed: " + ", ".join(failed))
+        raise SystemExit(1)
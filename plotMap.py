@@ -1,9 +1,11 @@
 import numpy
+import os
 import pickle
 from matplotlib import pyplot as plt, colors
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 import numpy as np
 import mesh
+from PointCloud import loadColumnar
 import argparse as ap
 import chart_studio.plotly as py
 import plotly.figure_factory as FF
@@ -20,8 +22,13 @@ def visualizeMap(brain, type, ax):
 
     norm = colors.Normalize(vmin = 0, vmax = 3)
 
-    with open('hippocampus/thicknessMap/dataframes/brain' + brain + '/cartesian_pc_ras_brain' + brain, 'rb') as input:
-        cartesian_data_ras = pickle.load(input)
+    # Point clouds are stored as memory-mappable arrays; older runs pickled the dataframe
+    pc_path = 'hippocampus/thicknessMap/dataframes/brain' + brain + '/cartesian_pc_ras_brain' + brain
+    if os.path.isdir(pc_path):
+        cartesian_data_ras = loadColumnar(pc_path, system = "RAS")
+    else:
+        with open(pc_path, 'rb') as input:
+            cartesian_data_ras = pickle.load(input)
 
     with open('hippocampus/thicknessMap/dataframes/brain' + brain + '/uvw_thickness_brain' + brain, 'rb') as input:
         uvw_thickness = pickle.load(input)
@@ -30,13 +37,16 @@ def visualizeMap(brain, type, ax):
         Q = pickle.load(input)
 
     Vthickness, Fthickness = mesh.meshSource(uvw_thickness)
-    l, lw = mesh.kNN(Q, cartesian_data_ras, 5)
-    bd_presub = mesh.surfaceIsocontour(Vthickness, Fthickness, lw, 0, t=0.5)
-    bd_sub = mesh.surfaceIsocontour(Vthickness, Fthickness, lw, 1, t=0.5)
-    bd_parasub = mesh.surfaceIsocontour(Vthickness, Fthickness, lw, 2, t=0.5)
-    bd_ca1 = mesh.surfaceIsocontour(Vthickness, Fthickness, lw, 3, t=0.5)
-    bd_ca2 = mesh.surfaceIsocontour(Vthickness, Fthickness, lw, 4, t=0.5)
-    bd_ca3 = mesh.surfaceIsocontour(Vthickness, Fthickness, lw, 5, t=0.5)
+    # Index the point cloud once; any other surface can be labeled against the same index
+    index = mesh.LabelIndex(cartesian_data_ras)
+    l, lw = mesh.kNN(Q, index, 5)
+    contours = mesh.surfaceIsocontours(Vthickness, Fthickness, lw, t=0.5)
+    bd_presub = mesh.joinPolylines(contours[(0, 0.5)])
+    bd_sub = mesh.joinPolylines(contours[(1, 0.5)])
+    bd_parasub = mesh.joinPolylines(contours[(2, 0.5)])
+    bd_ca1 = mesh.joinPolylines(contours[(3, 0.5)])
+    bd_ca2 = mesh.joinPolylines(contours[(4, 0.5)])
+    bd_ca3 = mesh.joinPolylines(contours[(5, 0.5)])
 
     #fig, ax = plt.subplots(figsize = (10, 10))
     tcf = ax.tricontourf(Vthickness[:, 0].detach().numpy(),
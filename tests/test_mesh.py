@@ -0,0 +1,53 @@
+import numpy as np
+import nibabel as nib
+import pytest
+from skimage import measure
+
+import mesh
+
+lewiner = pytest.mark.skipif(not hasattr(measure, 'marching_cubes_lewiner'),
+                             reason = "mesh.py uses skimage's marching_cubes_lewiner")
+
+
+@pytest.fixture
+def ellipsoid(tmp_path):
+    x, y, z = np.mgrid[-12:13, -12:13, -8:9]
+    vol = ((x / 10.) ** 2 + (y / 10.) ** 2 + (z / 4.) ** 2 < 1).astype(np.uint8)
+    path = str(tmp_path / 'ellipsoid.img')
+    nib.save(nib.AnalyzeImage(vol, np.eye(4)), path)
+
+    return path
+
+
+@lewiner
+@pytest.mark.parametrize("first_slice, last_slice", [(0, 10), (0, 14), (4, 22), (0, 25)])
+def test_meshTargetChunked_uneven_slabs(ellipsoid, first_slice, last_slice):
+    """Slabs that do not divide the slice range, including trailing slabs thinner than the step"""
+    V, F = mesh.meshTargetChunked(ellipsoid, first_slice, last_slice, step = 2, slab = 4)
+    Vref, Fref = mesh.meshTarget(ellipsoid, first_slice, last_slice, step = 2, weld = True)
+
+    assert V.shape == Vref.shape and F.shape == Fref.shape
+    assert np.allclose(np.unique(V.numpy(), axis = 0), np.unique(Vref.numpy(), axis = 0))
+    assert np.array_equal(np.sort(np.sort(V[F].numpy().reshape(-1, 9), axis = 1), axis = 0),
+                          np.sort(np.sort(Vref[Fref].numpy().reshape(-1, 9), axis = 1), axis = 0))
+
+
+def test_surfaceIsocontours_several_thresholds():
+    """One pass over several thresholds gives the segments of separate single-threshold calls"""
+    u, v = np.meshgrid(np.linspace(-1, 1, 30), np.linspace(-1, 1, 30), indexing = 'ij')
+    V, F = mesh.meshSource(np.stack([u, v, np.zeros_like(u)], -1))
+    r = np.sqrt(u ** 2 + v ** 2).reshape(-1)
+    lw = np.stack([1 - r, np.clip(u.reshape(-1) + .5, 0, 1), (r < .5).astype(float)], 1)
+
+    thresholds = [0.3, 0.5, 0.6]
+    contours = mesh.surfaceIsocontours(V, F, lw, t = thresholds)
+
+    assert set(contours) == {(region, t) for region in range(3) for t in thresholds}
+    for t in thresholds:
+        single = mesh.surfaceIsocontours(V, F, lw, t = t)
+        for region in range(3):
+            assert len(contours[(region, t)]) == len(single[(region, t)])
+            for a, b in zip(contours[(region, t)], single[(region, t)]):
+                assert np.array_equal(a, b)
+            assert np.array_equal(mesh.surfaceIsocontour(V, F, lw, region, t),
+                                  mesh.joinPolylines(single[(region, t)]), equal_nan = True)
@@ -0,0 +1,22 @@
+import torch
+
+import mesh
+from Optimization import TargetCurrents
+
+
+def K(x, y, u, v, b):
+    return (u * v).sum(1, keepdim = True)
+
+
+def test_TargetCurrents_cache_is_bounded():
+    V, F = mesh.meshSource(torch.rand(6, 6, 3).numpy())
+    TargetCurrents._cache.clear()
+
+    first = TargetCurrents.get(V, F, [1.], K, torch.float32, 'cpu')
+    assert TargetCurrents.get(V, F, [1.], K, torch.float32, 'cpu') is first
+
+    for s in range(2, 2 + TargetCurrents.cache_size):
+        TargetCurrents.get(V, F, [float(s)], K, torch.float32, 'cpu')
+
+    assert len(TargetCurrents._cache) == TargetCurrents.cache_size
+    assert TargetCurrents.get(V, F, [1.], K, torch.float32, 'cpu') is not first
@@ -0,0 +1,71 @@
+import os
+import pickle
+import numpy as np
+import nibabel as nib
+import pandas as pd
+import pytest
+
+from PointCloud import PointCloud, extractVoxels, saveColumnar, loadColumnar
+
+
+def frames():
+    data = pd.DataFrame(np.array([[1, 2, 3], [4, 5, 6]]))
+    data_ras = pd.DataFrame(np.array([[.5, 1., 1.5], [2., 2.5, 3.]]))
+    data['label'] = data_ras['label'] = pd.Categorical.from_codes([0, 1], categories = ['ca1', 'ca2'])
+
+    return data, data_ras
+
+
+@pytest.fixture
+def volume(tmp_path):
+    x, y, z = np.mgrid[-6:7, -6:7, -4:5]
+    vol = ((x / 5.) ** 2 + (y / 5.) ** 2 + (z / 3.) ** 2 < 1).astype(np.uint8)
+    path = str(tmp_path / 'volume.img')
+    nib.save(nib.AnalyzeImage(vol, np.diag([.5, .5, 1., 1.])), path)
+
+    return path
+
+
+def test_saveColumnar_replaces_pickle(tmp_path):
+    """Older runs pickled the dataframe at the path saveColumnar now writes"""
+    path = str(tmp_path / 'cartesian_pc_ras_brain2')
+    data, data_ras = frames()
+    with open(path, 'wb') as output:
+        pickle.dump(data_ras, output)
+
+    saveColumnar(path, data, data_ras)
+
+    loaded = loadColumnar(path, system = "RAS")
+    assert np.allclose(loaded[[0, 1, 2]].values, data_ras[[0, 1, 2]].values)
+    assert list(loaded['label']) == ['ca1', 'ca2']
+    assert os.listdir(str(tmp_path)) == ['cartesian_pc_ras_brain2']
+
+
+def test_saveColumnar_cleans_up_on_failure(tmp_path):
+    path = str(tmp_path / 'pc')
+    data, data_ras = frames()
+
+    with pytest.raises(KeyError):
+        saveColumnar(path, data, data_ras.drop(columns = [2]))
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_Cartesian_cache_hit_and_miss_agree(tmp_path, volume):
+    cache_dir = str(tmp_path / 'cache')
+    miss = PointCloud(volume, combined = True).Cartesian(2, 9, system = "RAS", cache_dir = cache_dir)
+    hit = PointCloud(volume, combined = True).Cartesian(2, 9, system = "RAS", cache_dir = cache_dir)
+
+    assert list(miss.dtypes) == list(hit.dtypes)
+    assert np.array_equal(miss.values, hit.values)
+
+
+def test_extractVoxels_open_slice_ranges(volume):
+    ijk, ras, affine = extractVoxels(volume)
+    axis = ijk[:, 1]
+
+    for min, max in [(3, None), (None, 7), (3, 7)]:
+        sub, sub_ras, affine = extractVoxels(volume, rc_axis = 1, min = min, max = max)
+        keep = (axis >= (axis.min() if min is None else min)) & (axis <= (axis.max() if max is None else max))
+        assert np.array_equal(sub, ijk[keep])
+        assert np.allclose(sub_ras, ras[keep])